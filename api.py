@@ -5,14 +5,23 @@
 import datetime
 import logging
 import hashlib
+import hmac
 import uuid
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 import json
 import os
 import re
-from scoring import get_score, get_interests
-from store import Store
+import gc
+import signal
+import socket
+import sys
+import threading
+import time
+import Queue
+from scoring import get_score, get_scores, get_interests_many, score_key, interests_key, flights, refreshes
+from store import Store, BatchStore, BloomFilter, DeadlineExceeded, LocalCache, deadline
+from backends import RedisBackend, MemoryBackend
 from abc import ABCMeta, abstractmethod
 
 
@@ -25,13 +34,19 @@ FORBIDDEN = 403
 NOT_FOUND = 404
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
+GATEWAY_TIMEOUT = 504
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
+    GATEWAY_TIMEOUT: "Gateway Timeout",
 }
+MAX_CLIENT_IDS = 10000
+MAX_PROFILES = 10000
 UNKNOWN = 0
 MALE = 1
 FEMALE = 2
@@ -45,10 +60,17 @@ class ValidationError(Exception):
     pass
 
 
+EMAIL_RE = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
+PHONE_RE = re.compile(r"7\d{10}")
+DATE_RE = re.compile(r"\d{2}\.\d{2}\.\d{4}")
+
+
 class Field(object):
+    cost = 0
 
     def __init__(self, required, nullable=False):
         self.label = None
+        self.slot = None
         self.required = required
         self.nullable = nullable
 
@@ -65,15 +87,30 @@ class Field(object):
         elif required:
             raise ValidationError("Field %s must be present" % self.label)
 
+    def check_source(self):
+        lines = []
+        if not self.nullable:
+            lines += ["if value is not None and not value:",
+                      "    raise ValidationError(%r)" % ("Field %s must be not nullables" % self.label)]
+        if self.required:
+            lines += ["if value is None:",
+                      "    raise ValidationError(%r)" % ("Field %s must be present" % self.label)]
+        return lines
+
+    def validate_source(self):
+        return ["value = fields[%r].validate(value)" % self.label]
+
     def __set__(self, instance, value):
         self.check_nullable_required(self.required, self.nullable, value)
         if value is None:
-            instance.__dict__[self.label] = value
+            setattr(instance, self.slot, value)
         else:
-            instance.__dict__[self.label] = self.validate(value)
+            setattr(instance, self.slot, self.validate(value))
 
     def __get__(self, instance, owner):
-        return instance.__dict__.get(self.label, None)
+        if instance is None:
+            return self
+        return getattr(instance, self.slot, None)
 
 
 class CharField(Field):
@@ -86,6 +123,10 @@ class CharField(Field):
         else:
             raise ValidationError('Field %s is not a string' % self.label)
 
+    def validate_source(self):
+        return ["if not isinstance(value, (str, unicode)):",
+                "    raise ValidationError(%r)" % ('Field %s is not a string' % self.label)]
+
 
 class ArgumentsField(Field):
     def __init__(self, required, nullable):
@@ -97,6 +138,10 @@ class ArgumentsField(Field):
         else:
             raise ValidationError('Arguments is not a valid json')
 
+    def validate_source(self):
+        return ["if not isinstance(value, dict):",
+                "    raise ValidationError('Arguments is not a valid json')"]
+
 
 class EmailField(Field):
 
@@ -105,13 +150,19 @@ class EmailField(Field):
 
     def validate(self, value):
         if isinstance(value, str) or isinstance(value, unicode):
-            if re.match(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)", value):
+            if EMAIL_RE.match(value):
                 return value
             else:
                 raise ValidationError('Email format is not valid')
         else:
             raise ValidationError('Email field has a wrong type')
 
+    def validate_source(self):
+        return ["if not isinstance(value, (str, unicode)):",
+                "    raise ValidationError('Email field has a wrong type')",
+                "if not EMAIL_RE.match(value):",
+                "    raise ValidationError('Email format is not valid')"]
+
 
 class PhoneField(Field):
 
@@ -122,13 +173,20 @@ class PhoneField(Field):
         if isinstance(value, long) or isinstance(value, str) or isinstance(value, unicode)\
                 or isinstance(value, int):
             value = str(value)
-            if re.match(r"7\d{10}", value) and len(value) == 11:
+            if PHONE_RE.match(value) and len(value) == 11:
                 return value
             else:
                 raise ValidationError('Phone number not valid')
         else:
             raise ValidationError('Phone field has a wrong type')
 
+    def validate_source(self):
+        return ["if not isinstance(value, (long, str, unicode, int)):",
+                "    raise ValidationError('Phone field has a wrong type')",
+                "value = str(value)",
+                "if not PHONE_RE.match(value) or len(value) != 11:",
+                "    raise ValidationError('Phone number not valid')"]
+
 
 class DateField(Field):
 
@@ -137,22 +195,29 @@ class DateField(Field):
 
     def validate(self, value):
         if isinstance(value, str) or isinstance(value, unicode):
-            if re.match(r"\d{2}\.\d{2}\.\d{4}", value):
+            if DATE_RE.match(value):
                 return value
             else:
                 raise ValidationError('Date field is not a valid date')
         else:
             raise ValidationError('Date filed have a wrong type')
 
+    def validate_source(self):
+        return ["if not isinstance(value, (str, unicode)):",
+                "    raise ValidationError('Date filed have a wrong type')",
+                "if not DATE_RE.match(value):",
+                "    raise ValidationError('Date field is not a valid date')"]
+
 
 class BirthDayField(Field):
+    cost = 1
 
     def __init__(self, required, nullable):
         super(BirthDayField, self).__init__(required, nullable)
 
     def validate(self, value):
         if isinstance(value, str) or isinstance(value, unicode):
-            if re.match(r"\d{2}\.\d{2}\.\d{4}", value):
+            if DATE_RE.match(value):
                 value = datetime.datetime.strptime(value, '%d.%m.%Y')
                 delta = datetime.datetime.now() - value
                 if delta.days/365 < 70:
@@ -164,6 +229,15 @@ class BirthDayField(Field):
         else:
             raise ValidationError('Birthday filed have a wrong type')
 
+    def validate_source(self):
+        return ["if not isinstance(value, (str, unicode)):",
+                "    raise ValidationError('Birthday filed have a wrong type')",
+                "if not DATE_RE.match(value):",
+                "    raise ValidationError('Birthday field is not a valid date')",
+                "value = datetime.datetime.strptime(value, '%d.%m.%Y')",
+                "if (datetime.datetime.now() - value).days/365 >= 70:",
+                "    raise ValidationError(%r)" % 'Сlient has been born for more than 70 years']
+
 
 class GenderField(Field):
     def __init__(self, required, nullable):
@@ -178,19 +252,109 @@ class GenderField(Field):
         else:
             raise ValidationError('Gender filed has a wrong type')
 
+    def validate_source(self):
+        return ["if not isinstance(value, int):",
+                "    raise ValidationError('Gender filed has a wrong type')",
+                "if value not in (UNKNOWN, MALE, FEMALE):",
+                "    raise ValidationError('Wrong gender field value')"]
+
+
+class ListField(Field):
+    name = 'List'
+    item_type = object
+    item_error = 'Some item has a wrong type'
 
-class ClientIDsField(Field):
-    def __init__(self, required):
-        super(ClientIDsField, self).__init__(required)
+    def __init__(self, required, max_length=None):
+        super(ListField, self).__init__(required)
+        self.max_length = max_length
 
     def validate(self, value):
         if isinstance(value, list) or isinstance(value, tuple):
-            if all(isinstance(item, int) for item in value):
+            if self.max_length is not None and len(value) > self.max_length:
+                raise ValidationError('%s field has more than %s items' % (self.name, self.max_length))
+            if all(isinstance(item, self.item_type) for item in value):
                 return value
             else:
-                raise ValidationError('Some client id is not an integer value')
+                raise ValidationError(self.item_error)
         else:
-            raise ValidationError('Client ids field is not an array')
+            raise ValidationError('%s field is not an array' % self.name)
+
+    def validate_source(self):
+        return ["if not isinstance(value, (list, tuple)):",
+                "    raise ValidationError(%r)" % ('%s field is not an array' % self.name),
+                "max_length = fields[%r].max_length" % self.label,
+                "if max_length is not None and len(value) > max_length:",
+                "    raise ValidationError(%r %% max_length)" % ('%s field has more than %%s items' % self.name),
+                "item_type = fields[%r].item_type" % self.label,
+                "for item in value:",
+                "    if not isinstance(item, item_type):",
+                "        raise ValidationError(%r)" % self.item_error]
+
+
+class ClientIDsField(ListField):
+    name = 'Client ids'
+    item_type = int
+    item_error = 'Some client id is not an integer value'
+
+
+class ProfilesField(ListField):
+    name = 'Profiles'
+    item_type = dict
+    item_error = 'Some profile is not an object'
+
+
+def defined_in(cls, name):
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return klass
+
+
+def compile_validator(name, fields, fail_fast=False):
+    # one straight-line function per request class: the checks of every field are inlined,
+    # so building a request costs no descriptor calls or per-field method dispatch
+    if fail_fast:
+        # cheap fields first, and stop at the first error
+        name, fields = 'fast_' + name, sorted(fields, key=lambda field: field.cost)
+    lines = ["def validate_%s(self, request):" % name,
+             "    errors = None"]
+    for field in fields:
+        cls = type(field)
+        checks = field.check_source()
+        if defined_in(cls, 'check_nullable_required') is not Field:
+            checks = ["fields[%r].check_nullable_required(fields[%r].required, fields[%r].nullable, value)"
+                      % (field.label, field.label, field.label)]
+        validate = field.validate_source()
+        if defined_in(cls, 'validate_source') is not defined_in(cls, 'validate'):
+            validate = Field.validate_source.im_func(field)
+        lines += ["    value = request[%r] if %r in request else None" % (field.label, field.label),
+                  "    try:"]
+        lines += ["        " + line for line in checks]
+        lines += ["        if value is not None:"]
+        lines += ["            " + line for line in validate]
+        if fail_fast:
+            lines += ["    except ValidationError as E:",
+                      "        return [str(E)]"]
+        else:
+            lines += ["    except ValidationError as E:",
+                      "        value = None",
+                      "        if errors is None:",
+                      "            errors = []",
+                      "        errors.append(str(E))"]
+        lines += ["    self.%s = value" % field.slot]
+    lines += ["    return errors"]
+    namespace = {
+        'ValidationError': ValidationError,
+        'datetime': datetime,
+        'EMAIL_RE': EMAIL_RE,
+        'PHONE_RE': PHONE_RE,
+        'DATE_RE': DATE_RE,
+        'UNKNOWN': UNKNOWN,
+        'MALE': MALE,
+        'FEMALE': FEMALE,
+        'fields': dict((field.label, field) for field in fields),
+    }
+    exec compile("\n".join(lines), "<validator %s>" % name, "exec") in namespace
+    return namespace["validate_%s" % name]
 
 
 class DeclarativeMethodRequest(type):
@@ -200,28 +364,40 @@ class DeclarativeMethodRequest(type):
         for key, value in attrs.iteritems():
             if isinstance(value, Field):
                 value.label = key
+                value.slot = '_' + key
                 declared_fields.append(key)
         attrs['declarated_fields'] = declared_fields
+        # field values live in slots next to their descriptors, so requests carry no __dict__
+        attrs['__slots__'] = tuple(attrs.get('__slots__', ())) + tuple(attrs[key].slot for key in declared_fields)
+        attrs['validate_fields'] = compile_validator(name, [attrs[key] for key in declared_fields])
+        attrs['validate_fields_fast'] = compile_validator(name, [attrs[key] for key in declared_fields], True)
         return super(DeclarativeMethodRequest, mcs).__new__(mcs, name, bases, attrs)
 
 
 class Request(object):
     __metaclass__ = DeclarativeMethodRequest
+    __slots__ = ('_errors',)
+    fail_fast = False
 
     def __init__(self, request):
-        self.errors = []
-        for value in self.__class__.__dict__['declarated_fields']:
-            try:
-                if value in request:
-                    self.__setattr__(value, request[value])
-                else:
-                    self.__setattr__(value, None)
-            except ValidationError as E:
-                self.errors.append(str(E))
+        if self.fail_fast:
+            self._errors = self.validate_fields_fast(request)
+        else:
+            self._errors = self.validate_fields(request)
+
+    @property
+    def errors(self):
+        if self._errors is None:
+            return []
+        return self._errors
+
+    @errors.setter
+    def errors(self, errors):
+        self._errors = errors
 
     @property
     def is_valid(self):
-        if self.errors:
+        if self._errors:
             return False
         else:
             return True
@@ -254,6 +430,14 @@ class OnlineScoreRequest(Request):
         super(OnlineScoreRequest, self).__init__(request)
 
 
+
+class OnlineScoreBatchRequest(Request):
+    profiles = ProfilesField(required=True, max_length=MAX_PROFILES)
+
+    def __init__(self, request):
+        super(OnlineScoreBatchRequest, self).__init__(request)
+
+
 class ClientsInterestsRequest(Request):
     client_ids = ClientIDsField(required=True)
     date = DateField(required=False, nullable=True)
@@ -262,9 +446,7 @@ class ClientsInterestsRequest(Request):
         super(ClientsInterestsRequest, self).__init__(request)
 
     def handler(self, ctx, store):
-        interests = {}
-        for id in self.client_ids:
-            interests[id] = get_interests(store, id)
+        interests = get_interests_many(store, self.client_ids)
         if interests:
             ctx['nclients'] = len(self.client_ids)
             return 200, interests
@@ -273,16 +455,77 @@ class ClientsInterestsRequest(Request):
             return NOT_FOUND, 'Can not connect to store db'
 
 
+class AdminDigests(object):
+    def __init__(self, salt):
+        self.salt = salt
+        self.hours = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def digest(self, hour):
+        return hashlib.sha512(hour.strftime("%Y%m%d%H") + self.salt).hexdigest()
+
+    def rotate(self):
+        # (expires, digest) for the current and the next hour, so a rotation never hashes on the request path
+        hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+        known = dict(self.hours)
+        hours = []
+        for start in (hour, hour + datetime.timedelta(hours=1)):
+            expires = time.mktime((start + datetime.timedelta(hours=1)).timetuple())
+            hours.append((expires, known.get(expires) or self.digest(start)))
+        self.hours = hours
+
+    def tick(self):
+        self.rotate()
+        self.timer = threading.Timer(max(self.hours[0][0] - time.time(), 0), self.tick)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def current(self):
+        if self.timer is None:
+            # only the first caller starts the rotation timer chain
+            with self.lock:
+                if self.timer is None:
+                    self.tick()
+        hours = self.hours
+        if time.time() >= hours[0][0]:
+            self.rotate()
+            hours = self.hours
+        return hours[0][1]
+
+
+def ascii_token(token):
+    if isinstance(token, unicode):
+        try:
+            return token.encode('ascii')
+        except UnicodeEncodeError:
+            return None
+    return token
+
+
+admin_digests = AdminDigests(ADMIN_SALT)
+verified_tokens = LocalCache(10000, 24 * 60 * 60)
+
+
 def check_auth(request):
     logging.debug('checking auth')
+    token = ascii_token(request.token)
+    if token is None:
+        return False
     if request.is_admin:
         logging.debug('is admin')
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
-    else:
-        logging.debug('not an admin')
-        digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
-    if digest == request.token:
+        if hmac.compare_digest(admin_digests.current(), token):
+            logging.debug('success auth')
+            return True
+        return False
+    logging.debug('not an admin')
+    key = (request.account, request.login, token)
+    if verified_tokens.get(key):
+        return True
+    digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
+    if hmac.compare_digest(digest, token):
         logging.debug('success auth')
+        verified_tokens.set(key, True, verified_tokens.ttl)
         return True
     return False
 
@@ -301,6 +544,9 @@ class Handler(object):
         code = INVALID_REQUEST
         return responce, code
 
+    def store_keys(self):
+        return [], []
+
     def handler(self):
         pass
 
@@ -309,14 +555,27 @@ class OnlineScoreRequestHandler(Handler):
     def __init__(self, request, ctx, store):
         super(OnlineScoreRequestHandler, self).__init__(request, ctx, store)
 
-    def handler(self):
+    def get_fields(self):
         fields = []
         for field in self.request.declarated_fields:
             if getattr(self.request, field):
                 fields.append(field)
-        if ('phone' in fields and 'email' in fields) \
+        return fields
+
+    def has_enough(self, fields):
+        return ('phone' in fields and 'email' in fields) \
             or ('first_name' in fields and 'last_name' in fields) \
-            or ('gender' in fields and 'birthday' in fields):
+            or ('gender' in fields and 'birthday' in fields)
+
+    def store_keys(self):
+        if not self.has_enough(self.get_fields()):
+            return [], []
+        return [], [score_key(self.request.phone, self.request.birthday,
+                              self.request.first_name, self.request.last_name)]
+
+    def handler(self):
+        fields = self.get_fields()
+        if self.has_enough(fields):
             score = get_score(self.store, self.request.phone, self.request.email, self.request.birthday,
                                   self.request.gender, self.request.first_name, self.request.last_name)
             self.ctx['has'] = fields
@@ -326,17 +585,57 @@ class OnlineScoreRequestHandler(Handler):
             return 'Two much null arguments', INVALID_REQUEST,
 
 
+
+class OnlineScoreBatchRequestHandler(Handler):
+    def __init__(self, request, ctx, store):
+        super(OnlineScoreBatchRequestHandler, self).__init__(request, ctx, store)
+        self.profiles = []
+        if self.request.is_valid:
+            self.profiles = [OnlineScoreRequestHandler(OnlineScoreRequest(profile), {}, store)
+                             for profile in self.request.profiles]
+
+    def scored(self):
+        return [profile for profile in self.profiles
+                if profile.request.is_valid and profile.has_enough(profile.get_fields())]
+
+    def store_keys(self):
+        return [], [key for profile in self.scored() for key in profile.store_keys()[1]]
+
+    def handler(self):
+        if not self.request.is_valid:
+            responce, code = self.get_error()
+            return responce, code
+        scored = self.scored()
+        scores = get_scores(self.store, [(profile.request.phone, profile.request.email, profile.request.birthday,
+                                          profile.request.gender, profile.request.first_name,
+                                          profile.request.last_name) for profile in scored])
+        scores = dict(zip(map(id, scored), scores))
+        responces = []
+        for profile in self.profiles:
+            if not profile.request.is_valid:
+                responces.append(make_response(*profile.get_error()))
+            elif id(profile) in scores:
+                responces.append(make_response({'score': scores[id(profile)]}, OK))
+            else:
+                responces.append(make_response('Two much null arguments', INVALID_REQUEST))
+        self.ctx['nprofiles'] = len(self.profiles)
+        return responces, OK
+
+
 class ClientsInterestsRequestHandler(Handler):
     def __init__(self, request, ctx, store):
         super(ClientsInterestsRequestHandler, self).__init__(request, ctx, store)
 
+    def store_keys(self):
+        if not self.request.is_valid:
+            return [], []
+        return [interests_key(client_id) for client_id in self.request.client_ids], []
+
     def handler(self):
         if not self.request.is_valid:
             responce, code = self.get_error()
             return responce, code
-        interests = {}
-        for client_id in self.request.client_ids:
-            interests[client_id] = get_interests(self.store, client_id)
+        interests = get_interests_many(self.store, self.request.client_ids)
         if interests:
             self.ctx['nclients'] = len(self.request.client_ids)
             return interests, 200
@@ -349,29 +648,78 @@ class RequestHandler(Handler):
     def __init__(self, request, ctx, store):
         super(RequestHandler, self).__init__(request, ctx, store)
 
-    def handler(self):
+    def route(self):
         if not self.request.is_valid:
-            responce, code = self.get_error()
-            return responce, code
+            return None, self.get_error()
         logging.debug('request is valid')
         if not check_auth(self.request):
             logging.debug('forbidden')
-            return 'Forbidden', 403
+            return None, ('Forbidden', 403)
         if self.request.method == 'online_score':
             logging.debug('online score')
             if self.request.is_admin:
-                return {'score': 42}, 200
-            else:
-                responce, code = OnlineScoreRequestHandler(OnlineScoreRequest(self.request.arguments),
-                                                        self.ctx, self.store).handler()
-                return responce, code
+                return None, ({'score': 42}, 200)
+            return OnlineScoreRequestHandler(OnlineScoreRequest(self.request.arguments), self.ctx, self.store), None
+        if self.request.method == 'online_score_batch':
+            logging.debug('online score batch')
+            handler = OnlineScoreBatchRequestHandler(OnlineScoreBatchRequest(self.request.arguments),
+                                                     self.ctx, self.store)
+            if self.request.is_admin and handler.request.is_valid:
+                return None, ([make_response({'score': 42}, OK) for _ in handler.request.profiles], OK)
+            return handler, None
         if self.request.method == 'clients_interests':
             logging.debug('clients interests')
-            responce, code = ClientsInterestsRequestHandler(ClientsInterestsRequest(self.request.arguments),
-                                                            self.ctx, self.store).handler()
-            return responce, code
+            return ClientsInterestsRequestHandler(ClientsInterestsRequest(self.request.arguments),
+                                                  self.ctx, self.store), None
         logging.debug('wrong request method')
-        return 'Wrong request method', BAD_REQUEST
+        return None, ('Wrong request method', BAD_REQUEST)
+
+    def handler(self):
+        handler, result = self.route()
+        if handler is not None:
+            return handler.handler()
+        return result
+
+
+def make_response(responce, code):
+    if code not in ERRORS:
+        return {"responce": responce, "code": code}
+    return {"error": responce or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+def batch_handler(request, ctx, store):
+    if not isinstance(request['body'], list):
+        return 'Batch must be an array of method requests', INVALID_REQUEST
+    batch_store = BatchStore(store)
+    routes = []
+    for body in request['body']:
+        if not isinstance(body, dict):
+            routes.append((None, ('Method request must be an object', INVALID_REQUEST)))
+            continue
+        handler, result = RequestHandler(MethodRequest(body), {}, batch_store).route()
+        if handler is not None:
+            batch_store.plan(*handler.store_keys())
+        routes.append((handler, result))
+    batch_store.prefetch()
+    responces = []
+    for handler, result in routes:
+        if handler is not None:
+            try:
+                result = handler.handler()
+            except DeadlineExceeded as e:
+                logging.error("Deadline exceeded: %s" % e)
+                result = None, GATEWAY_TIMEOUT
+            except Exception as e:
+                logging.exception("Unexpected error: %s" % e)
+                result = None, INTERNAL_ERROR
+        responces.append(make_response(*result))
+    batch_store.flush()
+    ctx['nrequests'] = len(responces)
+    return responces, OK
+
+
+def create_store(**options):
+    return Store('127.0.0.1', '6379', '6370', 10, 10, 3, **options)
 
 
 def method_handler(request, ctx, store):
@@ -382,19 +730,46 @@ def method_handler(request, ctx, store):
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
-        "method": method_handler
+        "method": method_handler,
+        "batch": batch_handler,
     }
-    store = Store('127.0.0.1', '6379', '6370', 10, 10, 3)
+    store = None
+    ready = threading.Event()
+    deadline = 0
+    protocol_version = "HTTP/1.1"
+    timeout = 5
+    max_requests = 100
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.requests_served = 0
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    def get_deadline(self, headers):
+        try:
+            budget = float(headers.get('X-Request-Deadline', self.deadline))
+        except ValueError:
+            budget = self.deadline
+        if budget > 0:
+            return time.time() + budget / 1000.0
+        return None
+
     def do_POST(self):
         responce, code = {}, OK
-        context = {"request_id": self.get_request_id(self.headers)}
+        context = {"request_id": self.get_request_id(self.headers), "deadline": self.get_deadline(self.headers)}
         request = None
+        self.requests_served += 1
+        if self.requests_served >= self.max_requests:
+            self.close_connection = 1
         try:
             data_string = self.rfile.read(int(self.headers['Content-Length']))
+        except Exception:
+            data_string = None
+            self.close_connection = 1
+        try:
             request = json.loads(data_string)
         except Exception:
             code = BAD_REQUEST
@@ -405,36 +780,103 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
             if path in self.router:
                 try:
-                    responce, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
+                    with deadline(context["deadline"]):
+                        responce, code = self.router[path]({"body": request, "headers": self.headers}, context,
+                                                           self.store)
+                except DeadlineExceeded as e:
+                    logging.error("Deadline exceeded: %s %s" % (e, context["request_id"]))
+                    code = GATEWAY_TIMEOUT
                 except Exception as e:
                     logging.exception("Unexpected error: %s" % e)
                     code = INTERNAL_ERROR
             else:
                 code = NOT_FOUND
 
+        r = make_response(responce, code)
+        context.update(r)
+        logging.info(context)
+        self.send_body(code, json.dumps(r))
+
+    def do_GET(self):
+        if self.path.strip("/") == "ready":
+            code = OK if self.ready.is_set() else SERVICE_UNAVAILABLE
+            self.send_body(code, json.dumps({"ready": self.ready.is_set()}))
+        elif self.path.strip("/") == "stats":
+            self.send_body(OK, json.dumps(self.stats()))
+        else:
+            self.send_body(NOT_FOUND, json.dumps(make_response(None, NOT_FOUND)))
+
+    def stats(self):
+        # per process: in prefork mode each worker reports its own pools, breakers and caches
+        stats = self.store.stats()
+        stats.update(pid=os.getpid(), flights=flights.stats(), refreshes=refreshes.stats(),
+                     tokens=verified_tokens.stats())
+        return stats
+
+    def send_body(self, code, body):
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", len(body))
+        # an idle keep-alive connection would hold a server that handles one connection at a time
+        if not getattr(self.server, 'concurrent', False):
+            self.close_connection = 1
+        if self.close_connection:
+            self.send_header("Connection", "close")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"responce": responce, "code": code}
-        else:
-            r = {"error": responce or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r))
-        return
+        self.wfile.write(body)
 
 
-if __name__ == "__main__":
-    log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opts.log')
-    op = OptionParser()
-    op.add_option("-p", "--port", action="store", type=int, default=8080)
-    op.add_option("-l", "--log", action="store", default=log_path)
-    (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
+class ThreadPoolHTTPServer(HTTPServer):
+    concurrent = True
+
+    def __init__(self, server_address, handler_class, workers, bind_and_activate=True):
+        HTTPServer.__init__(self, server_address, handler_class, bind_and_activate)
+        self.requests = Queue.Queue(workers)
+        for _ in range(workers):
+            worker = threading.Thread(target=self.process_request_thread)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_request_thread(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+def reuse_port_option():
+    # older Python 2 builds do not export SO_REUSEPORT; its value is only known for Linux
+    if hasattr(socket, 'SO_REUSEPORT'):
+        return socket.SO_REUSEPORT
+    if sys.platform.startswith('linux'):
+        return 15
+    return None
+
+
+def reuse_port_server(address, threads=1):
+    option = reuse_port_option()
+    if option is None:
+        raise ValueError("SO_REUSEPORT is not known on %s" % sys.platform)
+    # with more than one thread a worker keeps connections alive for the upstream proxy
+    if threads > 1:
+        server = ThreadPoolHTTPServer(address, MainHTTPHandler, threads, bind_and_activate=False)
+    else:
+        server = HTTPServer(address, MainHTTPHandler, bind_and_activate=False)
+    server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.socket.setsockopt(socket.SOL_SOCKET, option, 1)
+    server.server_bind()
+    server.server_activate()
+    return server
+
+
+def serve(server):
     try:
         server.serve_forever()
     except KeyboardInterrupt:
@@ -442,8 +884,195 @@ if __name__ == "__main__":
     server.server_close()
 
 
+BACKENDS = {
+    "redis": RedisBackend,
+    "memory": MemoryBackend,
+}
+
 
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host, int(port)
 
 
+def warm_store(store, hot_keys):
+    try:
+        with open(hot_keys) as f:
+            keys = json.load(f)
+        logging.info("Warmed %s of %s hot keys" % (store.warm(keys), len(keys)))
+    except Exception:
+        logging.exception("Cache warming from %s failed" % hot_keys)
+    finally:
+        MainHTTPHandler.ready.set()
+
+
+def snapshot_hot_keys(store, hot_keys, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            store.hot_keys.save(hot_keys)
+        except Exception:
+            logging.exception("Hot key snapshot to %s failed" % hot_keys)
+
+
+def prepare(store, hot_keys=None, warm="off", snapshot_interval=0):
+    if hot_keys and store.hot_keys is not None and snapshot_interval > 0:
+        thread = threading.Thread(target=snapshot_hot_keys, args=(store, hot_keys, snapshot_interval))
+        thread.daemon = True
+        thread.start()
+    if not hot_keys or warm == "off" or not os.path.exists(hot_keys):
+        MainHTTPHandler.ready.set()
+    elif warm == "sync":
+        warm_store(store, hot_keys)
+    else:
+        thread = threading.Thread(target=warm_store, args=(store, hot_keys))
+        thread.daemon = True
+        thread.start()
 
 
+def client_ids_limit(limit=None, fail_fast=False):
+    # the default mode keeps accepting batches of any size; fail-fast mode rejects huge ones unless told otherwise
+    if limit is None and fail_fast:
+        return MAX_CLIENT_IDS
+    return limit
+
+
+def default_pool_size(workers, warm="off"):
+    # request threads plus the background threads that share the same pools: stale score
+    # revalidation and background warming; the invalidation listener has a connection of its own
+    return workers + refreshes.workers + (1 if warm == "background" else 0)
+
+
+def serve_prefork(address, workers, store_options, warm_options, threads=1):
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    else:
+        gc.disable()
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            gc.enable()
+            MainHTTPHandler.store = create_store(**store_options)
+            prepare(MainHTTPHandler.store, **warm_options)
+            logging.info("Worker %s started" % os.getpid())
+            serve(reuse_port_server(address, threads))
+            os._exit(0)
+        children.append(pid)
+    try:
+        while children:
+            pid, status = os.wait()
+            children.remove(pid)
+            logging.info("Worker %s exited with status %s" % (pid, status))
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+if __name__ == "__main__":
+    log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opts.log')
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-l", "--log", action="store", default=log_path)
+    op.add_option("-w", "--workers", action="store", type=int, default=1)
+    op.add_option("-m", "--mode", action="store", type="choice", choices=["thread", "prefork"], default="thread")
+    op.add_option("--threads", action="store", type=int, default=8,
+                  help="request threads in each prefork worker, each serving one keep-alive connection at a time")
+    op.add_option("--deadline", action="store", type=float, default=MainHTTPHandler.deadline,
+                  help="default request budget in ms when X-Request-Deadline is absent, 0 disables")
+    op.add_option("--fail-fast", action="store_true", default=False,
+                  help="report only the first validation error of a request")
+    op.add_option("--max-client-ids", action="store", type=int, default=None,
+                  help="reject larger client_ids arrays, %s in fail-fast mode when unset" % MAX_CLIENT_IDS)
+    op.add_option("--max-profiles", action="store", type=int, default=MAX_PROFILES)
+    op.add_option("--token-cache-size", action="store", type=int, default=verified_tokens.max_size)
+    op.add_option("--socket-timeout", action="store", type=float, default=None,
+                  help="seconds a Redis command may block, the connect timeout when unset")
+    op.add_option("--keepalive-timeout", action="store", type=float, default=MainHTTPHandler.timeout,
+                  help="seconds an idle keep-alive connection holds a request thread; a single-threaded "
+                       "server (one thread-mode worker, or prefork with --threads 1) closes every connection")
+    op.add_option("--max-requests", action="store", type=int, default=MainHTTPHandler.max_requests)
+    op.add_option("--local-cache-size", action="store", type=int, default=0)
+    op.add_option("--local-cache-ttl", action="store", type=int, default=60)
+    op.add_option("--retry-delay", action="store", type=float, default=3)
+    op.add_option("--retry-max-delay", action="store", type=float, default=6)
+    op.add_option("--breaker-threshold", action="store", type=int, default=5)
+    op.add_option("--breaker-reset", action="store", type=float, default=10)
+    op.add_option("--pool-size", action="store", type=int, default=None)
+    op.add_option("--pool-timeout", action="store", type=float, default=5)
+    op.add_option("--cache-lock-timeout", action="store", type=float, default=0,
+                  help="seconds other processes wait for a score being recomputed, 0 disables")
+    op.add_option("--negative-cache-size", action="store", type=int, default=0)
+    op.add_option("--negative-cache-ttl", action="store", type=float, default=5)
+    op.add_option("--bloom", action="store", default=None, help="Bloom filter of known client ids written by loader.py")
+    op.add_option("--invalidation-channel", action="store", default=None,
+                  help="channel announcing changed keys, e.g. the loader's channel or __keyevent@0__:set")
+    op.add_option("--stale-grace", action="store", type=float, default=0,
+                  help="seconds past expiry a score is served stale while it is recomputed in the background")
+    op.add_option("--hot-keys", action="store", default=None, help="hot key snapshot file")
+    op.add_option("--hot-keys-size", action="store", type=int, default=10000)
+    op.add_option("--snapshot-interval", action="store", type=float, default=60)
+    op.add_option("--warm", action="store", type="choice", choices=["off", "sync", "background"], default="off",
+                  help="prefetch the hot key snapshot before serving, or in the background with /ready gating")
+    op.add_option("--backend", action="store", type="choice", choices=sorted(BACKENDS), default="redis")
+    op.add_option("--node", action="append", dest="nodes", default=[], help="primary host:port, repeatable")
+    op.add_option("--replica", action="append", dest="replicas", default=[],
+                  help="primary_host:port=replica_host:port, repeatable")
+    (opts, args) = op.parse_args()
+    if opts.mode == "prefork" and opts.workers > 1 and reuse_port_option() is None:
+        op.error("prefork mode needs SO_REUSEPORT, which is not known on %s" % sys.platform)
+    MainHTTPHandler.timeout = opts.keepalive_timeout
+    MainHTTPHandler.max_requests = opts.max_requests
+    MainHTTPHandler.deadline = opts.deadline
+    Request.fail_fast = opts.fail_fast
+    verified_tokens = LocalCache(opts.token_cache_size, verified_tokens.ttl)
+    ClientsInterestsRequest.client_ids.max_length = client_ids_limit(opts.max_client_ids, opts.fail_fast)
+    OnlineScoreBatchRequest.profiles.max_length = opts.max_profiles
+    store_options = {
+        "local_cache_size": opts.local_cache_size,
+        "local_cache_ttl": opts.local_cache_ttl,
+        "retry_delay": opts.retry_delay,
+        "retry_max_delay": opts.retry_max_delay,
+        "breaker_threshold": opts.breaker_threshold,
+        "breaker_reset": opts.breaker_reset,
+        "pool_size": opts.pool_size or default_pool_size(opts.workers if opts.mode == "thread" else opts.threads,
+                                                         opts.warm),
+        "pool_timeout": opts.pool_timeout,
+        "cache_lock_timeout": opts.cache_lock_timeout,
+        "negative_cache_size": opts.negative_cache_size,
+        "negative_cache_ttl": opts.negative_cache_ttl,
+        "invalidation_channel": opts.invalidation_channel,
+        "stale_grace": opts.stale_grace,
+        "socket_timeout": opts.socket_timeout,
+        "hot_keys_size": opts.hot_keys_size if opts.hot_keys else 0,
+        "backend": BACKENDS[opts.backend](),
+    }
+    if opts.bloom:
+        store_options["bloom"] = BloomFilter.load(opts.bloom)
+    if opts.nodes:
+        store_options["nodes"] = [parse_address(node) for node in opts.nodes]
+    if opts.replicas:
+        replicas = {}
+        for replica in opts.replicas:
+            primary, _, address = replica.partition('=')
+            replicas.setdefault("%s:%s" % parse_address(primary), []).append(parse_address(address))
+        store_options["replicas"] = replicas
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    address = ("localhost", opts.port)
+    logging.info("Starting server at %s (%s mode, %s workers)" % (opts.port, opts.mode, opts.workers))
+    warm_options = {"hot_keys": opts.hot_keys, "warm": opts.warm, "snapshot_interval": opts.snapshot_interval}
+    if opts.mode == "prefork" and opts.workers > 1:
+        serve_prefork(address, opts.workers, store_options, warm_options, opts.threads)
+    else:
+        # prefork workers build their own stores after the fork, so only this branch needs one
+        MainHTTPHandler.store = create_store(**store_options)
+        prepare(MainHTTPHandler.store, **warm_options)
+        if opts.workers <= 1:
+            serve(HTTPServer(address, MainHTTPHandler))
+        else:
+            serve(ThreadPoolHTTPServer(address, MainHTTPHandler, opts.workers))
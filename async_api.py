@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from functools import wraps
+from optparse import OptionParser
+from BaseHTTPServer import BaseHTTPRequestHandler
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import trollius as asyncio
+from trollius import From, Return
+
+from api import method_handler, make_response, OK, BAD_REQUEST, NOT_FOUND, INTERNAL_ERROR, GATEWAY_TIMEOUT
+from store import (CircuitBreaker, CircuitOpenError, DeadlineExceeded, decode_cache_record, deadline,
+                   is_legacy_record, remaining)
+
+
+class RedisError(Exception):
+    pass
+
+
+def async_retry(backend='database', throw_exception=True):
+    def deco_retry(f):
+        @wraps(f)
+        @asyncio.coroutine
+        def f_retry(*args, **kwargs):
+            store = args[0]
+            breaker = store.breakers[backend]
+            error = None
+            for attempt in range(store.trys):
+                if not breaker.allow():
+                    error = error or CircuitOpenError('%s circuit is open' % backend)
+                    break
+                try:
+                    result = yield From(f(*args, **kwargs))
+                except (Return, asyncio.CancelledError):
+                    raise
+                except Exception as E:
+                    breaker.failure()
+                    error = E
+                    if attempt + 1 < store.trys:
+                        yield From(asyncio.sleep(store.retry_pause(attempt), loop=store.loop))
+                else:
+                    breaker.success()
+                    raise Return(result)
+            if throw_exception:
+                raise error
+            if isinstance(error, CircuitOpenError):
+                logging.error(error)
+            else:
+                logging.exception(error)
+            raise Return(None)
+
+        return f_retry
+    return deco_retry
+
+
+def encode_command(args):
+    parts = ['*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+        elif not isinstance(arg, str):
+            arg = str(arg)
+        parts.append('$%d\r\n%s\r\n' % (len(arg), arg))
+    return ''.join(parts)
+
+
+@asyncio.coroutine
+def read_reply(reader):
+    line = yield From(reader.readline())
+    if not line.endswith('\r\n'):
+        raise IOError('Connection closed by server')
+    prefix, rest = line[0], line[1:-2]
+    if prefix == '+':
+        raise Return(rest)
+    if prefix == '-':
+        raise RedisError(rest)
+    if prefix == ':':
+        raise Return(int(rest))
+    if prefix == '$':
+        length = int(rest)
+        if length == -1:
+            raise Return(None)
+        data = yield From(reader.readexactly(length + 2))
+        raise Return(data[:-2])
+    if prefix == '*':
+        length = int(rest)
+        if length == -1:
+            raise Return(None)
+        items = []
+        for _ in range(length):
+            item = yield From(read_reply(reader))
+            items.append(item)
+        raise Return(items)
+    raise RedisError('Unknown reply: %r' % line)
+
+
+class AsyncRedis(object):
+    def __init__(self, host, port, timeout=None, max_connections=64, loop=None):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.loop = loop
+        self.idle = []
+        self.slots = asyncio.Semaphore(max_connections, loop=loop)
+
+    @asyncio.coroutine
+    def connect(self):
+        connection = asyncio.open_connection(self.host, self.port, loop=self.loop)
+        reader, writer = yield From(asyncio.wait_for(connection, self.timeout, loop=self.loop))
+        raise Return((reader, writer))
+
+    @asyncio.coroutine
+    def execute(self, *args):
+        replies = yield From(self.pipeline([args]))
+        if isinstance(replies[0], RedisError):
+            raise replies[0]
+        raise Return(replies[0])
+
+    @asyncio.coroutine
+    def pipeline(self, commands):
+        # one write for all commands on one connection; error replies are returned in place
+        yield From(self.slots.acquire())
+        try:
+            if self.idle:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = yield From(self.connect())
+            try:
+                writer.write(''.join(encode_command(args) for args in commands))
+                replies = []
+                for _ in commands:
+                    try:
+                        reply = yield From(asyncio.wait_for(read_reply(reader), self.timeout, loop=self.loop))
+                    except RedisError as e:
+                        reply = e
+                    replies.append(reply)
+            except Exception:
+                writer.close()
+                raise
+            self.idle.append((reader, writer))
+            raise Return(replies)
+        finally:
+            self.slots.release()
+
+    @asyncio.coroutine
+    def get(self, key):
+        value = yield From(self.execute('GET', key))
+        raise Return(value)
+
+    @asyncio.coroutine
+    def set(self, key, value):
+        result = yield From(self.execute('SET', key, value))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def set_nx_px(self, key, value, milliseconds):
+        result = yield From(self.execute('SET', key, value, 'PX', milliseconds, 'NX'))
+        raise Return(result is not None)
+
+    @asyncio.coroutine
+    def mget(self, keys):
+        values = yield From(self.execute('MGET', *keys))
+        raise Return(values)
+
+    def close(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            writer.close()
+
+
+class AsyncStore(object):
+    def __init__(self, host, port, local_port, timeout, trys, max_connections=64, loop=None, chunk_size=500,
+                 retry_delay=3, retry_backoff=2, retry_max_delay=6, breaker_threshold=5, breaker_reset=10):
+        self.trys = trys
+        self.chunk_size = chunk_size
+        self.retry_delay = retry_delay
+        self.retry_backoff = retry_backoff
+        self.retry_max_delay = retry_max_delay
+        self.breakers = {
+            'database': CircuitBreaker('database', breaker_threshold, breaker_reset),
+            'cache': CircuitBreaker('cache', breaker_threshold, breaker_reset),
+        }
+        self.database = AsyncRedis(host, port, timeout, max_connections, loop)
+        self.cache_database = AsyncRedis('127.0.0.1', local_port, timeout, max_connections, loop)
+        self.loop = self.database.loop
+
+    def retry_pause(self, attempt):
+        delay = min(self.retry_max_delay, self.retry_delay * self.retry_backoff ** attempt)
+        return random.uniform(delay / 2.0, delay)
+
+    @async_retry()
+    @asyncio.coroutine
+    def set(self, key, value):
+        yield From(self.database.set(key, value))
+
+    @asyncio.coroutine
+    def cache_get(self, key):
+        value = yield From(self.cache_fetch(key))
+        if value is not None:
+            raise Return(value)
+        user_record = yield From(self.fallback_get(key))
+        if user_record:
+            user_record = int(user_record)
+        raise Return(user_record)
+
+    @async_retry('cache', throw_exception=False)
+    @asyncio.coroutine
+    def cache_fetch(self, key):
+        record, pttl = yield From(self.cache_database.pipeline([('GET', key), ('PTTL', key)]))
+        value, ttl = decode_cache_record(record, pttl)
+        if is_legacy_record(record, pttl):
+            yield From(self.expire_legacy([(key, ttl)]))
+        raise Return(value)
+
+    @asyncio.coroutine
+    def expire_legacy(self, records):
+        yield From(self.cache_database.pipeline([('PEXPIRE', key, int(ttl * 1000)) if ttl > 0 else ('DEL', key)
+                                                 for key, ttl in records]))
+
+    @async_retry(throw_exception=False)
+    @asyncio.coroutine
+    def fallback_get(self, key):
+        user_record = yield From(self.database.get(key))
+        raise Return(user_record)
+
+    @async_retry()
+    @asyncio.coroutine
+    def get(self, key):
+        user_record = yield From(self.database.get(key))
+        raise Return(user_record)
+
+    @async_retry()
+    @asyncio.coroutine
+    def get_many(self, keys):
+        chunks = [self.database.mget(keys[start:start + self.chunk_size])
+                  for start in range(0, len(keys), self.chunk_size)]
+        chunks = yield From(asyncio.gather(*chunks, loop=self.database.loop))
+        raise Return([value for chunk in chunks for value in chunk])
+
+    @asyncio.coroutine
+    def get_pipelined(self, keys):
+        values = yield From(self.get_many(keys))
+        raise Return(dict(zip(keys, values)))
+
+    @async_retry('cache', throw_exception=False)
+    @asyncio.coroutine
+    def cache_get_pipelined(self, keys, stale=None):
+        commands = []
+        for key in keys:
+            commands.extend([('GET', key), ('PTTL', key)])
+        replies = yield From(self.cache_database.pipeline(commands))
+        values, legacy = {}, []
+        for key, record, pttl in zip(keys, replies[::2], replies[1::2]):
+            values[key], ttl = decode_cache_record(record, pttl)
+            if is_legacy_record(record, pttl):
+                legacy.append((key, ttl))
+        if legacy:
+            yield From(self.expire_legacy(legacy))
+        raise Return(values)
+
+    @async_retry('cache', throw_exception=False)
+    @asyncio.coroutine
+    def cache_set(self, key, value, time):
+        yield From(self.cache_database.set_nx_px(key, value, int(time * 1000)))
+
+    @async_retry('cache', throw_exception=False)
+    @asyncio.coroutine
+    def cache_set_many(self, items):
+        yield From(self.cache_database.pipeline([('SET', key, value, 'PX', int(time * 1000), 'NX')
+                                                 for key, value, time in items]))
+
+    def close(self):
+        self.database.close()
+        self.cache_database.close()
+
+
+class StoreBridge(object):
+    def __init__(self, store, loop):
+        self.store = store
+        self.loop = loop
+
+    def call(self, method, *args):
+        # coroutines run on the loop thread, so the caller's deadline travels as a wait_for budget
+        left = remaining()
+        if left is not None and left <= 0:
+            raise DeadlineExceeded('no time left for %s' % method)
+        future = Future()
+
+        def done(task):
+            if task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def schedule():
+            coroutine = getattr(self.store, method)(*args)
+            if left is not None:
+                coroutine = asyncio.wait_for(coroutine, left, loop=self.loop)
+            task = asyncio.ensure_future(coroutine, loop=self.loop)
+            task.add_done_callback(done)
+
+        self.loop.call_soon_threadsafe(schedule)
+        try:
+            return future.result()
+        except asyncio.TimeoutError:
+            if left is not None and remaining() <= 0:
+                raise DeadlineExceeded('no time left for %s' % method)
+            raise
+
+    def set(self, key, value):
+        return self.call('set', key, value)
+
+    def get(self, key):
+        return self.call('get', key)
+
+    def get_many(self, keys):
+        return self.call('get_many', keys)
+
+    def cache_get(self, key):
+        return self.call('cache_get', key)
+
+    def cache_lookup(self, key):
+        return self.cache_get(key), False
+
+    def cache_set(self, key, value, time):
+        return self.call('cache_set', key, value, time)
+
+    def cache_get_pipelined(self, keys, stale=None):
+        return self.call('cache_get_pipelined', keys)
+
+    def get_pipelined(self, keys):
+        return self.call('get_pipelined', keys)
+
+    def cache_set_many(self, items):
+        return self.call('cache_set_many', items)
+
+
+class AsyncHTTPServer(object):
+    router = {
+        "method": method_handler
+    }
+    protocol_version = "HTTP/1.1"
+    responses = BaseHTTPRequestHandler.responses
+
+    def __init__(self, store, executor, idle_timeout=60, loop=None, deadline=0):
+        self.loop = loop or asyncio.get_event_loop()
+        self.store = StoreBridge(store, self.loop)
+        self.executor = executor
+        self.idle_timeout = idle_timeout
+        self.deadline = deadline
+
+    def get_deadline(self, headers):
+        try:
+            budget = float(headers.get('x-request-deadline', self.deadline))
+        except ValueError:
+            budget = self.deadline
+        if budget > 0:
+            return time.time() + budget / 1000.0
+        return None
+
+    def route(self, path, request, context):
+        # runs on an executor thread, where the store bridge reads the deadline
+        with deadline(context["deadline"]):
+            return self.router[path](request, context, self.store)
+
+    @asyncio.coroutine
+    def read_request(self, reader):
+        line = yield From(asyncio.wait_for(reader.readline(), self.idle_timeout, loop=self.loop))
+        if not line.strip():
+            raise Return(None)
+        command, path, version = line.split()
+        headers = {}
+        while True:
+            line = yield From(reader.readline())
+            if line in ('\r\n', '\n', ''):
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        body = ''
+        if length:
+            body = yield From(reader.readexactly(length))
+        raise Return((command, path, version, headers, body))
+
+    @asyncio.coroutine
+    def dispatch(self, path, headers, body):
+        responce, code = {}, OK
+        context = {"request_id": headers.get('x-request-id', uuid.uuid4().hex),
+                   "deadline": self.get_deadline(headers)}
+        request = None
+        try:
+            request = json.loads(body)
+        except Exception:
+            code = BAD_REQUEST
+
+        if request:
+            logging.info(request)
+            logging.info("%s: %s %s" % (path, body, context["request_id"]))
+            path = path.strip("/")
+            if path in self.router:
+                try:
+                    responce, code = yield From(self.loop.run_in_executor(
+                        self.executor, self.route, path, {"body": request, "headers": headers}, context))
+                except DeadlineExceeded as e:
+                    logging.error("Deadline exceeded: %s %s" % (e, context["request_id"]))
+                    code = GATEWAY_TIMEOUT
+                except Exception as e:
+                    logging.exception("Unexpected error: %s" % e)
+                    code = INTERNAL_ERROR
+            else:
+                code = NOT_FOUND
+
+        r = make_response(responce, code)
+        context.update(r)
+        logging.info(context)
+        raise Return((code, json.dumps(r)))
+
+    def write_response(self, writer, code, body, keep_alive):
+        head = "%s %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n" % (
+            self.protocol_version, code, self.responses.get(code, ('',))[0], len(body))
+        if not keep_alive:
+            head += "Connection: close\r\n"
+        writer.write(head + "\r\n" + body)
+
+    @asyncio.coroutine
+    def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = yield From(self.read_request(reader))
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                    break
+                if request is None:
+                    break
+                command, path, version, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                if command != 'POST':
+                    code, response = BAD_REQUEST, json.dumps(make_response(None, BAD_REQUEST))
+                else:
+                    code, response = yield From(self.dispatch(path, headers, body))
+                self.write_response(writer, code, response, keep_alive)
+                yield From(writer.drain())
+                if not keep_alive:
+                    break
+        except Exception as e:
+            logging.exception("Connection error: %s" % e)
+        finally:
+            writer.close()
+
+    def start(self, host, port):
+        return self.loop.run_until_complete(asyncio.start_server(self.handle_connection, host, port,
+                                                                 loop=self.loop, backlog=1024))
+
+
+if __name__ == "__main__":
+    log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opts.log')
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-l", "--log", action="store", default=log_path)
+    op.add_option("-w", "--workers", action="store", type=int, default=256,
+                  help="handler threads; each holds one until its Redis calls return, "
+                       "so this caps the requests in flight per process")
+    op.add_option("-c", "--connections", action="store", type=int, default=256)
+    op.add_option("--deadline", action="store", type=float, default=0,
+                  help="default request budget in ms when X-Request-Deadline is absent, 0 disables")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    loop = asyncio.get_event_loop()
+    store = AsyncStore('127.0.0.1', '6379', '6370', 10, 3, opts.connections, loop)
+    server = AsyncHTTPServer(store, ThreadPoolExecutor(opts.workers), loop=loop, deadline=opts.deadline)
+    listener = server.start("localhost", opts.port)
+    logging.info("Starting asyncio server at %s" % opts.port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    listener.close()
+    loop.run_until_complete(listener.wait_closed())
+    store.close()
+    loop.close()
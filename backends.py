@@ -0,0 +1,311 @@
+import fnmatch
+import Queue
+import threading
+import time
+
+import redis
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    def __init__(self, *args, **kwargs):
+        # budget() gives the seconds left before the caller's deadline, or None when it has none
+        self.budget = kwargs.pop('budget', None) or (lambda: None)
+        super(InstrumentedConnectionPool, self).__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.acquired = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def get_connection(self, command_name, *keys, **options):
+        started = time.time()
+        waited = self.pool.empty()
+        budget = self.budget()
+        try:
+            if budget is None:
+                return super(InstrumentedConnectionPool, self).get_connection(command_name, *keys, **options)
+            return self.get_bounded_connection(max(budget, 0.001))
+        finally:
+            with self.stats_lock:
+                self.acquired += 1
+                if waited:
+                    self.waits += 1
+                    self.wait_time += time.time() - started
+
+    def get_bounded_connection(self, budget):
+        # BlockingConnectionPool.get_connection, with the pool wait, connects and socket reads
+        # cut down to the caller's budget until the connection is released
+        self._checkpid()
+        try:
+            connection = self.pool.get(block=True, timeout=min(self.timeout, budget))
+        except Queue.Empty:
+            raise redis.ConnectionError("No connection available.")
+        if connection is None:
+            connection = self.make_connection()
+        timeout = self.connection_kwargs.get('socket_timeout')
+        connect_timeout = self.connection_kwargs.get('socket_connect_timeout') or timeout
+        self.bound(connection, min(timeout or budget, budget), min(connect_timeout or budget, budget))
+        try:
+            connection.connect()
+            # a pooled socket the server has closed, or one holding unread data, is replaced
+            try:
+                if connection.can_read():
+                    raise redis.ConnectionError('Connection has data')
+            except redis.ConnectionError:
+                connection.disconnect()
+                connection.connect()
+                if connection.can_read():
+                    raise redis.ConnectionError('Connection not ready')
+        except BaseException:
+            connection.disconnect()
+            self.release(connection)
+            raise
+        return connection
+
+    def bound(self, connection, timeout, connect_timeout):
+        connection.socket_timeout = timeout
+        connection.socket_connect_timeout = connect_timeout
+        if connection._sock is not None:
+            connection._sock.settimeout(timeout)
+        # the parsers keep their own copy to restore after non-blocking reads
+        parser = connection._parser
+        if getattr(parser, '_buffer', None) is not None:
+            parser._buffer.socket_timeout = timeout
+        if hasattr(parser, '_socket_timeout'):
+            parser._socket_timeout = timeout
+
+    def release(self, connection):
+        timeout = self.connection_kwargs.get('socket_timeout')
+        if connection.socket_timeout != timeout:
+            self.bound(connection, timeout, self.connection_kwargs.get('socket_connect_timeout') or timeout)
+        super(InstrumentedConnectionPool, self).release(connection)
+
+    def stats(self):
+        idle = len([connection for connection in list(self.pool.queue) if connection is not None])
+        return {'max_size': self.max_connections, 'in_use': len(self._connections) - idle, 'idle': idle,
+                'acquired': self.acquired, 'waits': self.waits, 'wait_time': self.wait_time}
+
+
+class Backend(object):
+    def connect(self, host, port, **options):
+        raise NotImplementedError
+
+    def stats(self, client):
+        return {}
+
+    def pubsub(self, client, **options):
+        return client.pubsub(**options)
+
+
+class RedisBackend(Backend):
+    def connect(self, host, port, **options):
+        return redis.StrictRedis(connection_pool=InstrumentedConnectionPool(host=host, port=port, **options))
+
+    def pubsub(self, client, **options):
+        # a subscriber keeps its connection for good, so it gets its own instead of one from the bounded pool
+        pool = client.connection_pool
+        subscriber = redis.ConnectionPool(connection_class=pool.connection_class, max_connections=1,
+                                          **pool.connection_kwargs)
+        return redis.StrictRedis(connection_pool=subscriber).pubsub(**options)
+
+    def stats(self, client):
+        return client.connection_pool.stats()
+
+
+def encode(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MemoryPipeline(object):
+    def __init__(self, database):
+        self.database = database
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.database, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        with self.database.lock:
+            return [method(*args, **kwargs) for method, args, kwargs in commands]
+
+
+class MemoryPubSub(object):
+    def __init__(self, database, ignore_subscribe_messages=False):
+        self.database = database
+        self.ignore_subscribe_messages = ignore_subscribe_messages
+        self.channels = set()
+        self.messages = Queue.Queue()
+
+    def subscribe(self, *channels):
+        for channel in map(encode, channels):
+            self.channels.add(channel)
+            self.database.subscribe(channel, self)
+            if not self.ignore_subscribe_messages:
+                self.messages.put({'type': 'subscribe', 'pattern': None, 'channel': channel,
+                                   'data': len(self.channels)})
+
+    def unsubscribe(self, *channels):
+        for channel in map(encode, channels or list(self.channels)):
+            self.channels.discard(channel)
+            self.database.unsubscribe(channel, self)
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        try:
+            return self.messages.get(timeout=timeout) if timeout else self.messages.get_nowait()
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        self.unsubscribe()
+
+
+class MemoryDatabase(object):
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.subscribers = {}
+        self.lock = threading.RLock()
+
+    def alive(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def get(self, key):
+        with self.lock:
+            if self.alive(encode(key)):
+                return self.data[encode(key)]
+            return None
+
+    def mget(self, keys, *args):
+        if isinstance(keys, basestring):
+            keys = [keys]
+        return [self.get(key) for key in list(keys) + list(args)]
+
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        key = encode(key)
+        with self.lock:
+            exists = self.alive(key)
+            if (nx and exists) or (xx and not exists):
+                return None
+            self.data[key] = encode(value)
+            self.expires.pop(key, None)
+            if ex is not None:
+                self.expires[key] = time.time() + ex
+            if px is not None:
+                self.expires[key] = time.time() + px / 1000.0
+            return True
+
+    def setex(self, key, time, value):
+        return self.set(key, value, ex=time)
+
+    def delete(self, *keys):
+        with self.lock:
+            deleted = 0
+            for key in map(encode, keys):
+                deleted += self.alive(key)
+                self.data.pop(key, None)
+                self.expires.pop(key, None)
+            return deleted
+
+    def exists(self, *keys):
+        with self.lock:
+            return sum(self.alive(encode(key)) for key in keys)
+
+    def pexpire(self, key, milliseconds):
+        key = encode(key)
+        with self.lock:
+            if not self.alive(key):
+                return False
+            self.expires[key] = time.time() + milliseconds / 1000.0
+            return True
+
+    def expire(self, key, seconds):
+        return self.pexpire(key, seconds * 1000)
+
+    def pttl(self, key):
+        key = encode(key)
+        with self.lock:
+            if not self.alive(key):
+                return -2
+            if key not in self.expires:
+                return -1
+            return int((self.expires[key] - time.time()) * 1000)
+
+    def ttl(self, key):
+        pttl = self.pttl(key)
+        return pttl if pttl < 0 else pttl // 1000
+
+    def scan(self, cursor=0, match=None, count=None):
+        with self.lock:
+            keys = sorted(key for key in self.data.keys() if self.alive(key))
+        cursor, count = int(cursor), count or 10
+        batch = keys[cursor:cursor + count]
+        if match is not None:
+            batch = [key for key in batch if fnmatch.fnmatchcase(key, match)]
+        next_cursor = cursor + count if cursor + count < len(keys) else 0
+        return next_cursor, batch
+
+    def dbsize(self):
+        with self.lock:
+            return len([key for key in self.data.keys() if self.alive(key)])
+
+    def flushdb(self):
+        with self.lock:
+            self.data.clear()
+            self.expires.clear()
+        return True
+
+    def ping(self):
+        return True
+
+    def subscribe(self, channel, pubsub):
+        with self.lock:
+            self.subscribers.setdefault(channel, set()).add(pubsub)
+
+    def unsubscribe(self, channel, pubsub):
+        with self.lock:
+            self.subscribers.get(channel, set()).discard(pubsub)
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(encode(channel), ()))
+        for pubsub in subscribers:
+            pubsub.messages.put({'type': 'message', 'pattern': None, 'channel': encode(channel),
+                                 'data': encode(message)})
+        return len(subscribers)
+
+    def pubsub(self, **kwargs):
+        return MemoryPubSub(self, **kwargs)
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def stats(self):
+        return {'keys': len(self.data), 'volatile': len(self.expires)}
+
+
+class MemoryBackend(Backend):
+    def __init__(self):
+        self.databases = {}
+        self.lock = threading.Lock()
+
+    def connect(self, host, port, **options):
+        with self.lock:
+            return self.databases.setdefault('%s:%s' % (host, port), MemoryDatabase())
+
+    def stats(self, client):
+        return client.stats()
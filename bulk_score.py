@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from optparse import OptionParser
+
+from api import OnlineScoreRequest, OnlineScoreRequestHandler
+from scoring import SCORE_TTL, compute_scores, score_key
+from store import Store
+
+store = None
+
+
+def parse_profile(line, fmt, columns=None):
+    line = line.strip()
+    if not line:
+        return None
+    if fmt == 'csv':
+        row = next(csv.reader([line]))
+        profile = dict((column, value) for column, value in zip(columns, row) if value != '')
+        if 'gender' in profile:
+            profile['gender'] = int(profile['gender'])
+        return profile
+    profile = json.loads(line)
+    if not isinstance(profile, dict):
+        raise ValueError('profile must be an object')
+    return profile
+
+
+def init_worker(store_args):
+    global store
+    if store_args is not None:
+        store = Store(*store_args)
+
+
+def score_chunk(chunk):
+    started = time.time()
+    fmt, columns, lines = chunk
+    results, requests = [], []
+    for number, line in lines:
+        try:
+            profile = parse_profile(line, fmt, columns)
+        except (ValueError, TypeError):
+            results.append({'line': number, 'error': 'Malformed record'})
+            continue
+        if profile is None:
+            continue
+        handler = OnlineScoreRequestHandler(OnlineScoreRequest(profile), {}, store)
+        if not handler.request.is_valid:
+            results.append({'line': number, 'error': '; '.join(handler.request.errors)})
+        elif not handler.has_enough(handler.get_fields()):
+            results.append({'line': number, 'error': 'Two much null arguments'})
+        else:
+            requests.append((number, profile.get('id'), handler.request))
+    rows = [(r.phone, r.email, r.birthday, r.gender, r.first_name, r.last_name) for _, _, r in requests]
+    scores = compute_scores(*zip(*rows)) if rows else []
+    items = []
+    for (number, profile_id, request), score in zip(requests, scores):
+        key = score_key(request.phone, request.birthday, request.first_name, request.last_name)
+        result = {'line': number, 'key': key, 'score': score}
+        if profile_id is not None:
+            result['id'] = profile_id
+        results.append(result)
+        items.append((key, score, SCORE_TTL))
+    if store is not None and items:
+        store.cache_set_many(items)
+    results.sort(key=lambda result: result['line'])
+    return os.getpid(), len(lines), len(items), results, time.time() - started
+
+
+class BulkScorer(object):
+    def __init__(self, workers=4, chunk_size=1000, store_args=None, report_interval=10):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.store_args = store_args
+        self.report_interval = report_interval
+        self.stats = {'records': 0, 'scored': 0, 'invalid': 0}
+        self.worker_stats = {}
+
+    def chunks(self, stream, fmt):
+        columns = None
+        if fmt == 'csv':
+            columns = next(csv.reader([stream.readline()]))
+        number = 1 if columns else 0
+        lines = []
+        for line in stream:
+            number += 1
+            lines.append((number, line))
+            if len(lines) >= self.chunk_size:
+                yield fmt, columns, lines
+                lines = []
+        if lines:
+            yield fmt, columns, lines
+
+    def write(self, result, output):
+        pid, records, scored, results, elapsed = result
+        for item in results:
+            output.write(json.dumps(item) + '\n')
+        self.stats['records'] += records
+        self.stats['scored'] += scored
+        self.stats['invalid'] += len(results) - scored
+        worker = self.worker_stats.setdefault(pid, {'records': 0, 'seconds': 0.0})
+        worker['records'] += records
+        worker['seconds'] += elapsed
+
+    def report(self, started):
+        elapsed = time.time() - started
+        logging.info("Scored %(scored)s of %(records)s records, %(invalid)s invalid" % self.stats +
+                     " (%.0f records/s)" % (self.stats['records'] / elapsed if elapsed else 0))
+        for pid, worker in sorted(self.worker_stats.items()):
+            logging.info("Worker %s: %s records, %.0f records/s" %
+                         (pid, worker['records'], worker['records'] / worker['seconds'] if worker['seconds'] else 0))
+
+    def run(self, path, output_path, fmt='jsonl'):
+        pool = multiprocessing.Pool(self.workers, init_worker, (self.store_args,))
+        # at most two chunks per worker in flight, so memory does not grow with the input
+        pending = deque()
+        started = reported = time.time()
+        try:
+            with open(path) as stream, open(output_path, 'w') as output:
+                for chunk in self.chunks(stream, fmt):
+                    pending.append(pool.apply_async(score_chunk, (chunk,)))
+                    while len(pending) >= self.workers * 2:
+                        self.write(pending.popleft().get(), output)
+                    if time.time() - reported >= self.report_interval:
+                        self.report(started)
+                        reported = time.time()
+                while pending:
+                    self.write(pending.popleft().get(), output)
+        except BaseException:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+        self.report(started)
+        return dict(self.stats, workers=self.worker_stats)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] INPUT OUTPUT")
+    op.add_option("--host", action="store", default="127.0.0.1")
+    op.add_option("-p", "--port", action="store", type=int, default=6379)
+    op.add_option("--cache-port", action="store", type=int, default=6370)
+    op.add_option("--prime", action="store_true", default=False, help="write the scores to the uid: score cache")
+    op.add_option("-f", "--format", action="store", choices=["jsonl", "csv"], default=None)
+    op.add_option("-c", "--chunk-size", action="store", type=int, default=1000)
+    op.add_option("-w", "--workers", action="store", type=int, default=multiprocessing.cpu_count())
+    op.add_option("-r", "--report-interval", action="store", type=float, default=10)
+    op.add_option("-l", "--log", action="store", default=None)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    if len(args) != 2:
+        op.error("input and output files are required")
+    fmt = opts.format or ('csv' if args[0].endswith('.csv') else 'jsonl')
+    store_args = (opts.host, opts.port, opts.cache_port, 10, 10, 3) if opts.prime else None
+    scorer = BulkScorer(opts.workers, opts.chunk_size, store_args, opts.report_interval)
+    try:
+        stats = scorer.run(args[0], args[1], fmt)
+    except KeyboardInterrupt:
+        logging.error("Interrupted, %s is incomplete" % args[1])
+        sys.exit(1)
+    logging.info("Done: scored %(scored)s of %(records)s records, %(invalid)s invalid" % stats)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import csv
+import json
+import logging
+import os
+import Queue
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+from scoring import InterestsEncoder, interests_key
+from store import BloomFilter, Store
+
+
+def parse_record(line, fmt):
+    line = line.strip()
+    if not line:
+        return None
+    if fmt == 'csv':
+        row = next(csv.reader([line]))
+        if row[0] == 'client_id':
+            return None
+        interests = [interest for interest in row[1].split('|') if interest] if len(row) > 1 else []
+        return int(row[0]), interests
+    record = json.loads(line)
+    interests = record['interests']
+    if not isinstance(interests, list) or not all(isinstance(i, basestring) for i in interests):
+        raise ValueError('interests must be a list of strings')
+    return int(record['client_id']), interests
+
+
+class Loader(object):
+    def __init__(self, store, batch_size=1000, workers=4, checkpoint=None, report_interval=10,
+                 checkpoint_interval=1, bloom_path=None, bloom_capacity=10 ** 7, bloom_error_rate=0.01,
+                 compact=False):
+        self.store = store
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.report_interval = report_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.bloom_path = bloom_path
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.bloom = None
+        self.compact = compact
+        self.queue = Queue.Queue(maxsize=workers * 2)
+        self.lock = threading.Lock()
+        self.failed = threading.Event()
+        self.pending = {}
+        self.next_batch = 0
+        self.state = {}
+        self.saved_at = 0
+
+    def read_checkpoint(self, path):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+            if state.get('path') == os.path.abspath(path):
+                return state
+            logging.warning("Checkpoint %s belongs to %s, starting over" % (self.checkpoint, state.get('path')))
+        return {'path': os.path.abspath(path), 'offset': 0, 'records': 0}
+
+    def write_checkpoint(self):
+        if not self.checkpoint:
+            return
+        if self.bloom is not None:
+            # the filter goes first, so it always covers every record the checkpoint counts as loaded
+            self.bloom.save(self.bloom_path)
+        temp = self.checkpoint + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(temp, self.checkpoint)
+        self.saved_at = time.time()
+
+    def commit(self, number, offset, count):
+        with self.lock:
+            self.pending[number] = (offset, count)
+            while self.next_batch in self.pending:
+                offset, count = self.pending.pop(self.next_batch)
+                self.state['offset'] = offset
+                self.state['records'] += count
+                self.next_batch += 1
+            if time.time() - self.saved_at >= self.checkpoint_interval:
+                self.write_checkpoint()
+
+    def writer(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            number, offset, items = batch
+            if self.failed.is_set():
+                continue
+            try:
+                self.store.set_many(items)
+            except Exception:
+                logging.exception("Batch %s ending at offset %s failed" % (number, offset))
+                self.failed.set()
+                continue
+            self.commit(number, offset, len(items))
+
+    def report(self, started, records):
+        elapsed = time.time() - started
+        logging.info("Loaded %s records (%.0f records/s), offset %s" %
+                     (self.state['records'], records / elapsed if elapsed else 0, self.state['offset']))
+
+    def load(self, path, fmt='jsonl'):
+        self.state = self.read_checkpoint(path)
+        resumed = self.state['records']
+        if self.state['offset']:
+            logging.info("Resuming %s from offset %s after %s records" % (path, self.state['offset'], resumed))
+        if self.bloom_path:
+            if os.path.exists(self.bloom_path):
+                # loads only add to an existing filter: one built from a partial or delta file would miss keys
+                self.bloom = BloomFilter.load(self.bloom_path)
+            elif self.state['offset']:
+                raise ValueError("Can not resume %s with a Bloom filter, %s is missing" % (path, self.bloom_path))
+            else:
+                self.bloom = BloomFilter.for_capacity(self.bloom_capacity, self.bloom_error_rate)
+        encode = InterestsEncoder(self.store).encode if self.compact else json.dumps
+        threads = [threading.Thread(target=self.writer) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        started = reported = time.time()
+        skipped, number, items = 0, 0, []
+        with open(path) as stream:
+            stream.seek(self.state['offset'])
+            for line in iter(stream.readline, ''):
+                try:
+                    record = parse_record(line, fmt)
+                except (ValueError, KeyError, TypeError, IndexError):
+                    logging.error("Skipping malformed record: %r" % line[:200])
+                    skipped += 1
+                    continue
+                if record is not None:
+                    items.append((interests_key(record[0]), encode(record[1])))
+                    if self.bloom is not None:
+                        self.bloom.add(items[-1][0])
+                if len(items) >= self.batch_size:
+                    self.queue.put((number, stream.tell(), items))
+                    number, items = number + 1, []
+                if self.failed.is_set():
+                    break
+                if time.time() - reported >= self.report_interval:
+                    self.report(started, self.state['records'] - resumed)
+                    reported = time.time()
+            if not self.failed.is_set():
+                self.queue.put((number, stream.tell(), items))
+        for thread in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+        with self.lock:
+            self.write_checkpoint()
+        if self.bloom is not None:
+            self.bloom.save(self.bloom_path)
+        self.report(started, self.state['records'] - resumed)
+        if self.failed.is_set():
+            return dict(self.state, skipped=skipped, failed=True)
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        return dict(self.state, skipped=skipped, failed=False)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] FILE")
+    op.add_option("--host", action="store", default="127.0.0.1")
+    op.add_option("-p", "--port", action="store", type=int, default=6379)
+    op.add_option("--node", action="append", default=[], help="primary node host:port, repeatable")
+    op.add_option("-f", "--format", action="store", choices=["jsonl", "csv"], default=None)
+    op.add_option("-b", "--batch-size", action="store", type=int, default=1000)
+    op.add_option("-w", "--workers", action="store", type=int, default=4)
+    op.add_option("-c", "--checkpoint", action="store", default=None)
+    op.add_option("-r", "--report-interval", action="store", type=float, default=10)
+    op.add_option("--bloom", action="store", default=None,
+                  help="add the loaded keys to the Bloom filter in this file, created if missing")
+    op.add_option("--bloom-capacity", action="store", type=int, default=10 ** 7)
+    op.add_option("--bloom-error-rate", action="store", type=float, default=0.01)
+    op.add_option("--invalidation-channel", action="store", default=None,
+                  help="publish loaded keys on this channel so servers drop their negative cache entries")
+    op.add_option("--compact", action="store_true", default=False,
+                  help="store interests as ids from the shared vocabulary instead of JSON")
+    op.add_option("-l", "--log", action="store", default=None)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    if len(args) != 1:
+        op.error("exactly one input file is required")
+    fmt = opts.format or ('csv' if args[0].endswith('.csv') else 'jsonl')
+    nodes = [tuple(node.rsplit(':', 1)) for node in opts.node] or None
+    store = Store(opts.host, opts.port, '6370', 10, 10, 3, pool_size=opts.workers + 1, nodes=nodes,
+                  invalidation_channel=opts.invalidation_channel)
+    loader = Loader(store, opts.batch_size, opts.workers, opts.checkpoint, opts.report_interval,
+                    bloom_path=opts.bloom, bloom_capacity=opts.bloom_capacity, bloom_error_rate=opts.bloom_error_rate,
+                    compact=opts.compact)
+    stats = loader.load(args[0], fmt)
+    logging.info("Loaded %(records)s records, skipped %(skipped)s, offset %(offset)s" % stats)
+    if stats['failed']:
+        logging.error("Load interrupted, rerun with the same checkpoint to resume")
+        sys.exit(1)
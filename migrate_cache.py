@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import datetime
+import json
+import logging
+from optparse import OptionParser
+
+import redis
+
+from store import LEGACY_TIME_FORMAT
+
+
+def migrate_legacy_cache(client, match='uid:*', count=1000, dry_run=False):
+    stats = {'scanned': 0, 'converted': 0, 'reclaimed': 0}
+    cursor = 0
+    while True:
+        cursor, keys = client.scan(cursor, match=match, count=count)
+        if keys:
+            stats['scanned'] += len(keys)
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                pipe.get(key)
+            records = pipe.execute()
+            now = datetime.datetime.now()
+            pipe = client.pipeline(transaction=False)
+            for key, record in zip(keys, records):
+                if not record or not record.startswith('{'):
+                    continue
+                try:
+                    record = json.loads(record)
+                    delta = datetime.datetime.strptime(record['time'], LEGACY_TIME_FORMAT) - now
+                except (ValueError, KeyError, TypeError):
+                    logging.error("Skipping malformed cache record %s" % key)
+                    continue
+                milliseconds = int(delta.total_seconds() * 1000)
+                if milliseconds > 0:
+                    pipe.set(key, record['value'], px=milliseconds, xx=True)
+                    stats['converted'] += 1
+                else:
+                    pipe.delete(key)
+                    stats['reclaimed'] += 1
+            if not dry_run:
+                pipe.execute()
+        if cursor == 0:
+            return stats
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("--host", action="store", default="127.0.0.1")
+    op.add_option("-p", "--port", action="store", type=int, default=6370)
+    op.add_option("-m", "--match", action="store", default="uid:*")
+    op.add_option("-c", "--count", action="store", type=int, default=1000)
+    op.add_option("-n", "--dry-run", action="store_true", default=False)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    client = redis.StrictRedis(host=opts.host, port=opts.port)
+    stats = migrate_legacy_cache(client, opts.match, opts.count, opts.dry_run)
+    logging.info("Scanned %(scanned)s keys, converted %(converted)s, reclaimed %(reclaimed)s" % stats)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import logging
+from optparse import OptionParser
+import select
+import SocketServer
+
+from backends import MemoryDatabase
+
+
+class CommandError(Exception):
+    pass
+
+
+def set_command(database, key, value, *options):
+    kwargs = {}
+    options = list(options)
+    while options:
+        option = options.pop(0).upper()
+        if option in ('EX', 'PX'):
+            kwargs[option.lower()] = int(options.pop(0))
+        elif option in ('NX', 'XX'):
+            kwargs[option.lower()] = True
+        else:
+            raise CommandError('syntax error')
+    return database.set(key, value, **kwargs)
+
+
+def scan_command(database, cursor, *options):
+    kwargs = {}
+    options = list(options)
+    while options:
+        option = options.pop(0).upper()
+        if option == 'MATCH':
+            kwargs['match'] = options.pop(0)
+        elif option == 'COUNT':
+            kwargs['count'] = int(options.pop(0))
+        else:
+            raise CommandError('syntax error')
+    cursor, keys = database.scan(cursor, **kwargs)
+    return [str(cursor), keys]
+
+
+COMMANDS = {
+    'PING': lambda database: 'PONG',
+    'GET': lambda database, key: database.get(key),
+    'MGET': lambda database, *keys: database.mget(keys),
+    'SET': set_command,
+    'SETEX': lambda database, key, seconds, value: database.set(key, value, ex=int(seconds)),
+    'DEL': lambda database, *keys: database.delete(*keys),
+    'EXISTS': lambda database, *keys: database.exists(*keys),
+    'EXPIRE': lambda database, key, seconds: int(database.expire(key, int(seconds))),
+    'PEXPIRE': lambda database, key, milliseconds: int(database.pexpire(key, int(milliseconds))),
+    'TTL': lambda database, key: database.ttl(key),
+    'PTTL': lambda database, key: database.pttl(key),
+    'SCAN': scan_command,
+    'DBSIZE': lambda database: database.dbsize(),
+    'FLUSHDB': lambda database: database.flushdb(),
+    'FLUSHALL': lambda database: database.flushdb(),
+    'SELECT': lambda database, index: True,
+    'PUBLISH': lambda database, channel, message: database.publish(channel, message),
+}
+
+
+def encode_reply(reply):
+    if reply is None:
+        return '$-1\r\n'
+    if reply is True:
+        return '+OK\r\n'
+    if isinstance(reply, (int, long)):
+        return ':%d\r\n' % reply
+    if isinstance(reply, list):
+        return '*%d\r\n%s' % (len(reply), ''.join(encode_reply(item) for item in reply))
+    return '$%d\r\n%s\r\n' % (len(reply), reply)
+
+
+class RESPRequestHandler(SocketServer.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith('*'):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def subscribe(self, channels):
+        pubsub = self.server.database.pubsub()
+        try:
+            pubsub.subscribe(*channels)
+            while True:
+                message = pubsub.get_message(timeout=0.05)
+                if message is not None:
+                    self.wfile.write(encode_reply([message['type'], message['channel'], message['data']]))
+                    continue
+                if not select.select([self.connection], [], [], 0)[0]:
+                    continue
+                args = self.read_command()
+                if args is None:
+                    return False
+                name = args[0].upper() if args else ''
+                if name == 'SUBSCRIBE':
+                    pubsub.subscribe(*args[1:])
+                elif name == 'UNSUBSCRIBE':
+                    for channel in args[1:] or sorted(pubsub.channels):
+                        pubsub.unsubscribe(channel)
+                        self.wfile.write(encode_reply(['unsubscribe', channel, len(pubsub.channels)]))
+                    if not pubsub.channels:
+                        return True
+                elif name == 'PING':
+                    self.wfile.write(encode_reply(['pong', args[1] if len(args) > 1 else '']))
+        finally:
+            pubsub.close()
+
+    def handle(self):
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            if not args:
+                continue
+            name = args[0].upper()
+            if name == 'SUBSCRIBE':
+                if not self.subscribe(args[1:]):
+                    return
+                continue
+            try:
+                if name not in COMMANDS:
+                    raise CommandError("unknown command '%s'" % args[0])
+                reply = encode_reply(COMMANDS[name](self.server.database, *args[1:]))
+            except (CommandError, TypeError, ValueError) as E:
+                reply = '-ERR %s\r\n' % E
+            self.wfile.write(reply)
+
+
+class RESPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, database=None):
+        SocketServer.ThreadingTCPServer.__init__(self, address, RESPRequestHandler)
+        self.database = database or MemoryDatabase()
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("--host", action="store", default="127.0.0.1")
+    op.add_option("-p", "--port", action="store", type=int, default=6379)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    server = RESPServer((opts.host, opts.port))
+    logging.info("Starting RESP stand-in server at %s:%s" % (opts.host, opts.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
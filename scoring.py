@@ -1,20 +1,64 @@
 import hashlib
 import json
+import logging
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+from store import DeadlineExceeded, Revalidator, SingleFlight
+
+SCORE_TTL = 60 * 60
+COMPACT_MARKER = 'v'
+VOCABULARY_KEY = 'vocabulary:interests'
+
+flights = SingleFlight()
+refreshes = Revalidator()
+# vocabulary versions are written once and never change, so they are cached for the life of the process
+vocabularies = {}
+
+
+def score_key(phone, birthday=None, first_name=None, last_name=None):
     key_parts = [
         first_name or "",
         last_name or "",
         phone or "",
         birthday.strftime("%Y%m%d") if birthday is not None else "",
     ]
+    return "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
+
+
+def interests_key(cid):
+    return "i:%s" % cid
+
+
+def vocabulary_key(version):
+    return "%s:%d" % (VOCABULARY_KEY, version)
+
 
-    key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = score_key(phone, birthday, first_name, last_name)
+    # concurrent lookups of the same key in this process share one in-flight call
+    return flights.do(key, lookup_score, store, key, phone, email, birthday, gender, first_name, last_name)
+
+
+def lookup_score(store, key, phone, email, birthday, gender, first_name, last_name):
     # try get from cache,
     # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
+    score, stale = store.cache_lookup(key)
     if score:
+        if stale:
+            # serve the stale score now, recompute it off the request path
+            refreshes.submit(key, refresh_score, store, key, phone, email, birthday, gender, first_name, last_name)
         return score
+    score = compute_score(phone, email, birthday, gender, first_name, last_name)
+    # cache for 60 minutes
+    store.cache_set(key, score, SCORE_TTL)
+    return score
+
+
+def refresh_score(store, key, phone, email, birthday, gender, first_name, last_name):
+    store.cache_refresh(key, compute_score(phone, email, birthday, gender, first_name, last_name), SCORE_TTL)
+
+
+def compute_score(phone, email, birthday, gender, first_name, last_name):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -23,13 +67,122 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
-    store.cache_set(key, score, 60 * 60)
     return score
 
 
+def compute_scores(phones, emails, birthdays, genders, first_names, last_names):
+    # compute_score over whole columns, one rule at a time
+    rules = [
+        (phones, 1.5),
+        (emails, 1.5),
+        ([birthday and gender for birthday, gender in zip(birthdays, genders)], 1.5),
+        ([first_name and last_name for first_name, last_name in zip(first_names, last_names)], 0.5),
+    ]
+    scores = [0] * len(phones)
+    for column, weight in rules:
+        scores = [score + weight if value else score for score, value in zip(scores, column)]
+    return scores
+
+
+def get_scores(store, profiles):
+    # profiles are (phone, email, birthday, gender, first_name, last_name) tuples;
+    # one pipelined cache read for all of them, then the misses are computed together and written back at once
+    keys = [score_key(phone, birthday, first_name, last_name)
+            for phone, email, birthday, gender, first_name, last_name in profiles]
+    stale = set()
+    scores = store.cache_get_pipelined(keys, stale) or {}
+    # reversed, so a key shared by several profiles is computed from the first of them
+    missing = dict((key, profile) for key, profile in reversed(zip(keys, profiles)) if not scores.get(key))
+    if missing:
+        try:
+            records = store.get_pipelined(missing.keys())
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logging.error("Can not read scores from store: %s" % e)
+            records = {}
+        for key in missing.keys():
+            if records.get(key):
+                scores[key] = int(records[key])
+                del missing[key]
+    if missing:
+        computed = zip(missing.keys(), compute_scores(*zip(*missing.values())))
+        scores.update(computed)
+        store.cache_set_many([(key, score, SCORE_TTL) for key, score in computed])
+    if stale:
+        profiles = dict(reversed(zip(keys, profiles)))
+        for key in stale:
+            refreshes.submit(key, refresh_score, store, key, *profiles[key])
+    return [scores[key] for key in keys]
+
+
+def load_vocabulary(store, version):
+    names = vocabularies.get(version)
+    if names is None:
+        record = store.get(vocabulary_key(version))
+        if not record:
+            raise ValueError('Unknown interests vocabulary version %s' % version)
+        names = vocabularies[version] = json.loads(record)
+    return names
+
+
+class InterestsEncoder(object):
+    # compact records are COMPACT_MARKER, the vocabulary version, ':' and one byte per interest id;
+    # the vocabulary only ever grows, and each growth is saved as a new version
+    def __init__(self, store):
+        self.store = store
+        version = store.get(VOCABULARY_KEY)
+        self.use(int(version) if version else 0, load_vocabulary(store, int(version)) if version else [])
+        self.catch_up()
+
+    def use(self, version, names):
+        self.version = version
+        self.names = list(names)
+        self.ids = dict((name, index) for index, name in enumerate(self.names))
+
+    def catch_up(self):
+        # VOCABULARY_KEY is only a hint: concurrent loaders may have created later versions
+        while True:
+            record = self.store.get(vocabulary_key(self.version + 1))
+            if not record:
+                return
+            self.use(self.version + 1, json.loads(record))
+            vocabularies[self.version] = list(self.names)
+
+    def add(self, name):
+        while name not in self.ids:
+            if len(self.names) >= 256:
+                raise ValueError('Interests vocabulary is full')
+            names = self.names + [name]
+            if self.store.set_nx(vocabulary_key(self.version + 1), json.dumps(names)):
+                self.use(self.version + 1, names)
+                vocabularies[self.version] = list(self.names)
+                self.store.set(VOCABULARY_KEY, self.version)
+            else:
+                self.catch_up()
+
+    def encode(self, interests):
+        for name in interests:
+            if name not in self.ids:
+                self.add(name)
+        return "%s%d:%s" % (COMPACT_MARKER, self.version, "".join(chr(self.ids[name]) for name in interests))
+
+
+def decode_interests(store, record):
+    if not record:
+        return []
+    if record[0] != COMPACT_MARKER:
+        return json.loads(record)
+    version, packed = record[1:].split(':', 1)
+    names = load_vocabulary(store, int(version))
+    return [names[ord(index)] for index in packed]
+
+
 def get_interests(store, cid):
-    print(cid)
-    r = store.get("i:%s" % cid)
-    print(r)
-    return json.loads(r) if r else []
+    r = store.get(interests_key(cid))
+    return decode_interests(store, r)
+
+
+def get_interests_many(store, cids):
+    records = store.get_many([interests_key(cid) for cid in cids])
+    return dict((cid, decode_interests(store, r)) for cid, r in zip(cids, records))
@@ -1,81 +1,850 @@
-import redis
+import bisect
 import datetime
+import hashlib
+import heapq
+import itertools
+import math
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
+from multiprocessing.pool import ThreadPool
+import random
+import threading
 import time
 import json
 import logging
-def retry(delay=3, backoff=2, throw_exception=True):
+import os
+import Queue
+
+from backends import RedisBackend
+
+LEGACY_TIME_FORMAT = '%d.%m.%Y %H:%M:%S'
+
+
+def is_legacy_record(record, pttl=-1):
+    # JSON envelopes written before scores carried a native TTL, not yet given one
+    return bool(record) and record.startswith('{') and pttl < 0
+
+
+def decode_cache_record(record, pttl=-1):
+    if not record:
+        return None, 0
+    if record.startswith('{'):
+        record = json.loads(record)
+        delta = datetime.datetime.strptime(record['time'], LEGACY_TIME_FORMAT) - datetime.datetime.now()
+        if delta > datetime.timedelta(0):
+            return record['value'], delta.total_seconds()
+        return None, 0
+    return float(record), pttl / 1000.0 if pttl > 0 else float('inf')
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+deadlines = threading.local()
+# a call failing this close to its deadline is taken to have been cut short by it
+DEADLINE_SLACK = 0.005
+
+
+@contextmanager
+def deadline(when):
+    previous = getattr(deadlines, 'when', None)
+    deadlines.when = when
+    try:
+        yield
+    finally:
+        deadlines.when = previous
+
+
+def remaining():
+    when = getattr(deadlines, 'when', None)
+    if when is None:
+        return None
+    return when - time.time()
+
+
+class CircuitBreaker(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=10):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.lock = threading.Lock()
+        self.counters = {'successes': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    def transition(self, state):
+        logging.warning("Circuit breaker %s: %s -> %s" % (self.name, self.state, state))
+        self.state = state
+        if state == self.OPEN:
+            self.opened_at = time.time()
+            self.counters['opened'] += 1
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.transition(self.HALF_OPEN)
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            self.counters['rejected'] += 1
+            return False
+
+    def release(self):
+        # the call ended without telling anything about the backend, so a half-open probe may go again
+        with self.lock:
+            self.probing = False
+
+    def success(self):
+        with self.lock:
+            self.counters['successes'] += 1
+            self.failures = 0
+            self.probing = False
+            if self.state != self.CLOSED:
+                self.transition(self.CLOSED)
+
+    def failure(self):
+        with self.lock:
+            self.counters['failures'] += 1
+            self.failures += 1
+            self.probing = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                                self.failures >= self.failure_threshold):
+                self.transition(self.OPEN)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['state'] = self.state
+        return stats
+
+
+def retry(backend='database', throw_exception=True):
     def deco_retry(f):
         @wraps(f)
         def f_retry(*args, **kwargs):
-            mtries, mdelay = args[0].trys, delay
-            while mtries > 1:
+            store = args[0]
+            breaker = store.breakers[backend]
+            error = None
+            for attempt in range(store.trys):
+                left = remaining()
+                if left is not None and left <= 0:
+                    error = DeadlineExceeded('no time left for %s' % f.__name__)
+                    break
+                if not breaker.allow():
+                    error = error or CircuitOpenError('%s circuit is open' % backend)
+                    break
                 try:
-                    return f(*args, **kwargs)
-                except Exception:
-                    time.sleep(mdelay)
-                    mtries -= 1
-                    mdelay *= backoff
-            if throw_exception:
-                return f(*args, **kwargs)
-            else:
-                try:
-                    return f(*args, **kwargs)
+                    result = f(*args, **kwargs)
+                except DeadlineExceeded:
+                    breaker.release()
+                    raise
                 except Exception as E:
-                    logging.exception(E)
+                    left = remaining()
+                    if left is not None and left <= DEADLINE_SLACK:
+                        # the pool cut the socket timeout to the caller's budget: the caller ran out of time,
+                        # which says nothing about the backend's health
+                        breaker.release()
+                        raise DeadlineExceeded('no time left for %s after %r' % (f.__name__, E))
+                    breaker.failure()
+                    error = E
+                    if attempt + 1 < store.trys:
+                        pause, left = store.retry_pause(attempt), remaining()
+                        if left is not None and pause >= left:
+                            error = DeadlineExceeded('no time left to retry %s after %r' % (f.__name__, E))
+                            break
+                        time.sleep(pause)
+                else:
+                    breaker.success()
+                    return result
+            if throw_exception or isinstance(error, DeadlineExceeded):
+                raise error
+            if isinstance(error, CircuitOpenError):
+                logging.error(error)
+            else:
+                logging.exception(error)
 
         return f_retry
     return deco_retry
 
+
+class HashRing(object):
+    def __init__(self, nodes, vnodes=160):
+        self.ring = sorted((self.hash('%s#%d' % (node, index)), node)
+                           for node in nodes for index in range(vnodes))
+        self.hashes = [point for point, node in self.ring]
+
+    def hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        index = bisect.bisect(self.hashes, self.hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class Shard(object):
+    def __init__(self, primary, replicas):
+        self.primary = primary
+        self.replicas = replicas
+        self.readers = itertools.cycle(replicas or [primary])
+
+    def reader(self):
+        return next(self.readers)
+
+
+class LocalCache(object):
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        ttl = min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + ttl)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class HotKeys(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def record(self, keys):
+        with self.lock:
+            for key in keys:
+                self.counts[key] = self.counts.get(key, 0) + 1
+            if len(self.counts) > 2 * self.max_size:
+                # keep the hottest half and age their counts so yesterday's hot keys can drop out
+                self.counts = dict((key, count // 2) for key, count in
+                                   heapq.nlargest(self.max_size, self.counts.iteritems(), key=lambda item: item[1]))
+
+    def top(self, count=None):
+        with self.lock:
+            items = heapq.nlargest(count or self.max_size, self.counts.iteritems(), key=lambda item: item[1])
+        return [key for key, hits in items]
+
+    def save(self, path):
+        temp = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(self.top(), f)
+        os.rename(temp, path)
+
+
+class BloomFilter(object):
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        return cls(size, max(1, int(round(size / float(capacity) * math.log(2)))))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            return cls(header['size'], header['hashes'], bytearray(f.read()))
+
+    def save(self, path):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(json.dumps({'size': self.size, 'hashes': self.hashes}) + '\n')
+            f.write(self.bits)
+        os.rename(path + '.tmp', path)
+
+    def positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        digest = hashlib.md5(key).hexdigest()
+        first, second = int(digest[:16], 16), int(digest[16:], 16) | 1
+        return [(first + index * second) % self.size for index in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, f, *args, **kwargs):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            if not flight.done.wait(remaining()):
+                raise DeadlineExceeded('no time left waiting for %s' % key)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = f(*args, **kwargs)
+        except Exception as E:
+            flight.error = E
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        return {'in_flight': len(self.flights), 'coalesced': self.coalesced}
+
+
+class Revalidator(object):
+    def __init__(self, workers=2, max_pending=1000):
+        self.workers = workers
+        self.pending = set()
+        self.queue = Queue.Queue(max_pending)
+        self.lock = threading.Lock()
+        self.threads = []
+        self.dropped = 0
+
+    def submit(self, key, f, *args):
+        with self.lock:
+            if key in self.pending:
+                return False
+            if not self.threads:
+                self.threads = [threading.Thread(target=self.worker) for _ in range(self.workers)]
+                for thread in self.threads:
+                    thread.daemon = True
+                    thread.start()
+            self.pending.add(key)
+        try:
+            self.queue.put_nowait((key, f, args))
+        except Queue.Full:
+            with self.lock:
+                self.pending.discard(key)
+                self.dropped += 1
+            return False
+        return True
+
+    def worker(self):
+        while True:
+            key, f, args = self.queue.get()
+            try:
+                f(*args)
+            except Exception:
+                logging.exception("Background refresh of %s failed" % key)
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+
+    def stats(self):
+        return {'pending': len(self.pending), 'dropped': self.dropped}
+
+
 class Store(object):
-    def __init__(self, host, port, local_port, timeout, keepalive, trys):
+    def __init__(self, host, port, local_port, timeout, keepalive, trys, chunk_size=500,
+                 local_cache_size=0, local_cache_ttl=60, retry_delay=3, retry_backoff=2, retry_max_delay=6,
+                 breaker_threshold=5, breaker_reset=10, pool_size=50, pool_timeout=5, health_check_interval=30,
+                 nodes=None, replicas=None, backend=None, cache_lock_timeout=0, cache_lock_poll=0.01,
+                 negative_cache_size=0, negative_cache_ttl=5, negative_prefix='i:', bloom=None,
+                 invalidation_channel=None, hot_keys_size=0, stale_grace=0, socket_timeout=None):
         self.host = host
         self.port = port
         self.timeout = timeout
         self.socket_keepalive = keepalive
         self.trys = trys
         self.local_port = local_port
-        self.database = redis.StrictRedis(host=self.host, port=self.port,
-                                          socket_connect_timeout=self.timeout,
-                                          socket_keepalive=self.socket_keepalive)
-        self.cache_database = redis.StrictRedis(host='127.0.0.1', port=self.local_port)
+        self.chunk_size = chunk_size
+        self.local_cache = LocalCache(local_cache_size, local_cache_ttl) if local_cache_size > 0 else None
+        self.negative_cache = LocalCache(negative_cache_size, negative_cache_ttl) if negative_cache_size > 0 else None
+        self.negative_cache_ttl = negative_cache_ttl
+        self.negative_prefix = negative_prefix
+        self.bloom = bloom
+        self.hot_keys = HotKeys(hot_keys_size) if hot_keys_size > 0 else None
+        self.invalidation_channel = invalidation_channel
+        self.retry_delay = retry_delay
+        self.retry_backoff = retry_backoff
+        self.retry_max_delay = retry_max_delay
+        self.cache_lock_timeout = cache_lock_timeout
+        self.cache_lock_poll = cache_lock_poll
+        self.stale_grace = stale_grace
+        self.breakers = {
+            'database': CircuitBreaker('database', breaker_threshold, breaker_reset),
+            'cache': CircuitBreaker('cache', breaker_threshold, breaker_reset),
+        }
+        self.pool_options = {'max_connections': pool_size, 'timeout': pool_timeout,
+                             'socket_connect_timeout': self.timeout, 'socket_keepalive': self.socket_keepalive,
+                             'health_check_interval': health_check_interval,
+                             'socket_timeout': socket_timeout or self.timeout, 'budget': remaining}
+        self.backend = backend or RedisBackend()
+        self.clients = {}
+        self.cache_database = self.connect('cache', '127.0.0.1', self.local_port, socket_timeout=self.timeout)
+        self.shards = OrderedDict()
+        replicas = replicas or {}
+        for node_host, node_port in nodes or [(host, port)]:
+            name = '%s:%s' % (node_host, node_port)
+            self.shards[name] = Shard(self.connect(name, node_host, node_port),
+                                      [self.connect('%s replica %s:%s' % (name, replica_host, replica_port),
+                                                    replica_host, replica_port)
+                                       for replica_host, replica_port in replicas.get(name, [])])
+        self.ring = HashRing(self.shards.keys())
+        self.database = self.shards.values()[0].primary
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        if invalidation_channel and (self.negative_cache is not None or bloom is not None):
+            listener = threading.Thread(target=self.listen_invalidations)
+            listener.daemon = True
+            listener.start()
+
+    def connect(self, name, host, port, **options):
+        options.update(self.pool_options)
+        self.clients[name] = self.backend.connect(host, port, **options)
+        return self.clients[name]
+
+    def node(self, key):
+        if len(self.shards) == 1:
+            return self.shards.keys()[0]
+        return self.ring.get_node(key)
+
+    def shard(self, key):
+        return self.shards[self.node(key)]
+
+    def group(self, keys):
+        groups = OrderedDict()
+        for key in keys:
+            groups.setdefault(self.node(key), []).append(key)
+        return groups
+
+    def parallel(self, f, groups):
+        if len(groups) <= 1:
+            return [f(group) for group in groups]
+        with self.executor_lock:
+            if self.executor is None:
+                # every caller reads one group itself and hands off at most one per other shard,
+                # and no shard serves more than max_connections callers at once
+                self.executor = ThreadPool((len(self.shards) - 1) * self.pool_options['max_connections'])
+        when = getattr(deadlines, 'when', None)
+
+        def call(group):
+            with deadline(when):
+                return f(group)
+        handed_off = self.executor.map_async(call, groups[1:])
+        first = f(groups[0])
+        return [first] + handed_off.get()
 
 
+    def retry_pause(self, attempt):
+        delay = min(self.retry_max_delay, self.retry_delay * self.retry_backoff ** attempt)
+        return random.uniform(delay / 2.0, delay)
+
     @retry()
     def set(self, key, value):
-        self.database.set(key, value)
+        self.shard(key).primary.set(key, value)
+        self.changed([key])
 
-    @retry(throw_exception=False)
-    def cache_get(self, key):
-        record = self.cache_database.get(key)
-        if record:
-            record = json.loads(record)
-            if datetime.datetime.now() < datetime.datetime.strptime(record['time'], '%d.%m.%Y %H:%M:%S',):
-                return record['value']
-        user_record = self.get(key)
+    @retry()
+    def set_nx(self, key, value):
+        created = bool(self.shard(key).primary.set(key, value, nx=True))
+        if created:
+            self.changed([key])
+        return created
+
+    @retry()
+    def set_many(self, items):
+        groups = OrderedDict()
+        for key, value in items:
+            groups.setdefault(self.node(key), []).append((key, value))
+        self.parallel(self.node_set_many, groups.items())
+        self.changed([key for key, value in items])
+
+    def node_set_many(self, group):
+        name, items = group
+        pipe = self.shards[name].primary.pipeline(transaction=False)
+        for key, value in items:
+            pipe.set(key, value)
+        return pipe.execute()
+
+    def known_missing(self, key):
+        if not key.startswith(self.negative_prefix):
+            return False
+        if self.bloom is not None and key not in self.bloom:
+            return True
+        return self.negative_cache is not None and self.negative_cache.get(key) is not None
+
+    def remember_missing(self, keys, values):
+        if self.negative_cache is None:
+            return
+        for key, value in zip(keys, values):
+            if value is None and key.startswith(self.negative_prefix):
+                self.negative_cache.set(key, True, self.negative_cache_ttl)
+
+    def forget_missing(self, keys):
+        for key in keys:
+            if not key.startswith(self.negative_prefix):
+                continue
+            if self.negative_cache is not None:
+                self.negative_cache.delete(key)
+            if self.bloom is not None:
+                self.bloom.add(key)
+
+    def changed(self, keys):
+        self.forget_missing(keys)
+        if self.invalidation_channel and keys:
+            self.database.publish(self.invalidation_channel, '\n'.join(keys))
+
+    def listen_invalidations(self):
+        while True:
+            try:
+                pubsub = self.backend.pubsub(self.database, ignore_subscribe_messages=True)
+                try:
+                    pubsub.subscribe(self.invalidation_channel)
+                    while True:
+                        message = pubsub.get_message(timeout=1)
+                        if message and message['type'] == 'message':
+                            self.forget_missing(message['data'].split())
+                finally:
+                    pubsub.close()
+            except Exception:
+                logging.exception("Invalidation listener on %s failed" % self.invalidation_channel)
+                if self.negative_cache is not None:
+                    self.negative_cache.clear()
+                time.sleep(self.retry_delay)
+
+    def local_get(self, key):
+        if self.local_cache is not None:
+            return self.local_cache.get(key)
+        return None
+
+    def local_set(self, key, value, ttl):
+        if self.local_cache is not None and value is not None:
+            self.local_cache.set(key, value, ttl)
+
+    def user_value(self, user_record):
         if user_record:
             user_record = int(user_record)
         return user_record
 
+    def cache_get(self, key):
+        return self.cache_lookup(key)[0]
+
+    def cache_lookup(self, key):
+        if self.hot_keys is not None:
+            self.hot_keys.record([key])
+        value = self.local_get(key)
+        if value is not None:
+            return value, False
+        value, stale = self.cache_fetch(key) or (None, False)
+        if value is not None:
+            return value, stale
+        locked = self.cache_lock(key) if self.cache_lock_timeout else None
+        if locked is False:
+            value = self.cache_wait(key)
+            if value is not None:
+                return value, False
+        value = self.user_value(self.fallback_get(key))
+        if locked and value is not None:
+            # the primary had it, so no cache_set follows to free the lease for the waiters
+            self.cache_unlock(key)
+        return value, False
+
+    def lock_key(self, key):
+        return 'lock:' + key
+
+    @retry('cache', throw_exception=False)
+    def cache_lock(self, key):
+        return bool(self.cache_database.set(self.lock_key(key), 1, px=int(self.cache_lock_timeout * 1000), nx=True))
+
+    @retry('cache', throw_exception=False)
+    def cache_unlock(self, key):
+        self.cache_database.delete(self.lock_key(key))
+
+    def cache_wait(self, key):
+        until = time.time() + self.cache_lock_timeout
+        if remaining() is not None:
+            until = min(until, time.time() + remaining())
+        while time.time() < until:
+            time.sleep(self.cache_lock_poll)
+            value, stale = self.cache_fetch(key) or (None, False)
+            if value is not None:
+                return value
+
+    @retry('cache', throw_exception=False)
+    def cache_fetch(self, key):
+        record, pttl = self.cache_database.pipeline(transaction=False).get(key).pttl(key).execute()
+        value, ttl = decode_cache_record(record, pttl)
+        if is_legacy_record(record, pttl):
+            self.expire_legacy([(key, ttl)])
+        # the last stale_grace seconds of a record's life are served stale and never cached in process
+        self.local_set(key, value, ttl - self.stale_grace)
+        return value, value is not None and ttl <= self.stale_grace
+
+    def expire_legacy(self, records):
+        # SET NX never replaces a key without a TTL, so an expired legacy envelope would block writes
+        # for good: live envelopes get a native TTL, expired ones are dropped
+        pipe = self.cache_database.pipeline(transaction=False)
+        for key, ttl in records:
+            if ttl > 0:
+                pipe.pexpire(key, int(ttl * 1000))
+            else:
+                pipe.delete(key)
+        pipe.execute()
+
+    @retry(throw_exception=False)
+    def fallback_get(self, key):
+        return self.shard(key).reader().get(key)
+
 
     @retry()
     def get(self, key):
-        user_record = self.database.get(key)
+        if self.known_missing(key):
+            return None
+        user_record = self.shard(key).reader().get(key)
+        self.remember_missing([key], [user_record])
         return user_record
 
-    @retry(throw_exception=False)
+    @retry('cache', throw_exception=False)
     def cache_set(self, key, value, time):
-        cache = self.cache_database.get(key)
-        if cache:
-            cache = json.loads(self.cache_database.get(key))
-            delta = datetime.datetime.now() - datetime.datetime.strptime(cache.get('time'), '%d.%m.%Y %H:%M:%S')
-            if delta.seconds > 0:
-                return None
-        cache = {}
-        cache['value'] = value
-        cache['time'] = datetime.datetime.now() + datetime.timedelta(seconds=time)
-        cache['time'] = cache['time'].strftime('%d.%m.%Y %H:%M:%S')
-        self.cache_database.set(key, json.dumps(cache))
+        pipe = self.cache_database.pipeline(transaction=False)
+        pipe.set(key, value, px=int((time + self.stale_grace) * 1000), nx=True)
+        if self.cache_lock_timeout:
+            pipe.delete(self.lock_key(key))
+        if pipe.execute()[0]:
+            self.local_set(key, value, time)
+
+    @retry('cache', throw_exception=False)
+    def cache_refresh(self, key, value, time):
+        self.cache_database.set(key, value, px=int((time + self.stale_grace) * 1000))
+        self.local_set(key, value, time)
+
+    @retry()
+    def get_many(self, keys):
+        groups = self.group([key for key in keys if not self.known_missing(key)]).items()
+        values = {}
+        for (name, node_keys), node_values in zip(groups, self.parallel(self.node_get_many, groups)):
+            values.update(zip(node_keys, node_values))
+            self.remember_missing(node_keys, node_values)
+        return [values.get(key) for key in keys]
+
+    def node_get_many(self, group):
+        name, keys = group
+        client = self.shards[name].reader()
+        if len(keys) <= self.chunk_size:
+            return client.mget(keys)
+        pipe = client.pipeline(transaction=False)
+        for start in range(0, len(keys), self.chunk_size):
+            pipe.mget(keys[start:start + self.chunk_size])
+        return [value for chunk in pipe.execute() for value in chunk]
+
+    @retry()
+    def get_pipelined(self, keys):
+        groups = self.group([key for key in keys if not self.known_missing(key)]).items()
+        records = dict.fromkeys(keys)
+        for (name, node_keys), node_values in zip(groups, self.parallel(self.node_get_pipelined, groups)):
+            records.update(zip(node_keys, node_values))
+            self.remember_missing(node_keys, node_values)
+        return records
+
+    def node_get_pipelined(self, group):
+        name, keys = group
+        pipe = self.shards[name].reader().pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+        return pipe.execute()
+
+    @retry('cache', throw_exception=False)
+    def cache_get_pipelined(self, keys, stale=None):
+        if self.hot_keys is not None:
+            self.hot_keys.record(keys)
+        values = dict((key, self.local_get(key)) for key in keys)
+        missing = [key for key in keys if values[key] is None]
+        if not missing:
+            return values
+        pipe = self.cache_database.pipeline(transaction=False)
+        for key in missing:
+            pipe.get(key).pttl(key)
+        replies = pipe.execute()
+        legacy = []
+        for key, record, pttl in zip(missing, replies[::2], replies[1::2]):
+            values[key], ttl = decode_cache_record(record, pttl)
+            if is_legacy_record(record, pttl):
+                legacy.append((key, ttl))
+            self.local_set(key, values[key], ttl - self.stale_grace)
+            if stale is not None and values[key] is not None and ttl <= self.stale_grace:
+                stale.add(key)
+        if legacy:
+            self.expire_legacy(legacy)
+        return values
+
+    @retry('cache', throw_exception=False)
+    def cache_set_many(self, items):
+        pipe = self.cache_database.pipeline(transaction=False)
+        for key, value, time in items:
+            pipe.set(key, value, px=int((time + self.stale_grace) * 1000), nx=True)
+        if self.cache_lock_timeout:
+            pipe.delete(*[self.lock_key(key) for key, value, time in items])
+        for (key, value, time), written in zip(items, pipe.execute()):
+            if written:
+                self.local_set(key, value, time)
+
+    def warm(self, keys, ttl=60 * 60):
+        warmed = 0
+        for start in range(0, len(keys), self.chunk_size):
+            batch = keys[start:start + self.chunk_size]
+            values = self.cache_get_pipelined(batch) or {}
+            missing = [key for key in batch if values.get(key) is None]
+            records = self.get_pipelined(missing) if missing else {}
+            items = [(key, self.user_value(records[key]), ttl) for key in missing if records.get(key)]
+            if items:
+                self.cache_set_many(items)
+            warmed += len(batch) - len(missing) + len(items)
+        return warmed
+
+    def stats(self):
+        stats = {}
+        if self.local_cache is not None:
+            stats['local_cache'] = self.local_cache.stats()
+        if self.negative_cache is not None:
+            stats['negative_cache'] = self.negative_cache.stats()
+        stats['breakers'] = dict((name, breaker.stats()) for name, breaker in self.breakers.items())
+        stats['pools'] = dict((name, self.backend.stats(client)) for name, client in self.clients.items())
+        return stats
+
+
+class BatchStore(object):
+    def __init__(self, store):
+        self.store = store
+        self.keys = set()
+        self.cache_keys = set()
+        self.records = {}
+        self.cache_records = {}
+        self.stale = set()
+        self.writes = []
+
+    def plan(self, keys, cache_keys):
+        self.keys.update(keys)
+        self.cache_keys.update(cache_keys)
+
+    def prefetch(self):
+        cache_keys = list(self.cache_keys)
+        if cache_keys:
+            self.cache_records = self.store.cache_get_pipelined(cache_keys, self.stale) or {}
+        # cache hits need nothing from the primary
+        keys = list(self.keys | set(key for key in cache_keys if self.cache_records.get(key) is None))
+        if keys:
+            self.records = self.store.get_pipelined(keys)
+        for key in cache_keys:
+            if self.cache_records.get(key) is None:
+                self.cache_records[key] = self.store.user_value(self.records.get(key))
+
+    def flush(self):
+        if self.writes:
+            self.store.cache_set_many(self.writes)
+        self.writes = []
+
+    def set(self, key, value):
+        return self.store.set(key, value)
+
+    def get(self, key):
+        if key in self.records:
+            return self.records[key]
+        return self.store.get(key)
+
+    def get_many(self, keys):
+        missing = [key for key in keys if key not in self.records]
+        if missing:
+            self.records.update(zip(missing, self.store.get_many(missing)))
+        return [self.records[key] for key in keys]
+
+    def cache_get(self, key):
+        if key in self.cache_records:
+            return self.cache_records[key]
+        return self.store.cache_get(key)
+
+    def cache_get_pipelined(self, keys, stale=None):
+        missing = [key for key in keys if key not in self.cache_records]
+        values = (self.store.cache_get_pipelined(missing, stale) or {}) if missing else {}
+        values.update((key, self.cache_records[key]) for key in keys if key in self.cache_records)
+        if stale is not None:
+            stale.update(key for key in keys if key in self.stale)
+        return values
+
+    def get_pipelined(self, keys):
+        missing = [key for key in keys if key not in self.records]
+        records = self.store.get_pipelined(missing) if missing else {}
+        records.update((key, self.records[key]) for key in keys if key in self.records)
+        return records
+
+    def cache_set_many(self, items):
+        self.writes.extend(items)
+
+    def cache_lookup(self, key):
+        if key in self.cache_records:
+            return self.cache_records[key], key in self.stale
+        return self.store.cache_lookup(key)
+
+    def cache_set(self, key, value, time):
+        self.writes.append((key, value, time))
+
+    def cache_refresh(self, key, value, time):
+        return self.store.cache_refresh(key, value, time)
 
 
 if __name__ == "__main__":
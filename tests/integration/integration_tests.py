@@ -84,8 +84,8 @@ class IntegrationTestsSuit(unittest.TestCase):
         request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": case}
         self.set_valid_auth(request)
         response, code = self.get_response(request)
-        self.assertEqual(json.loads(self.store.cache_database.get(key))['value'], case['result'])
-        self.assertIsNotNone(json.loads(self.store.cache_database.get(key))['time'])
+        self.assertEqual(float(self.store.cache_database.get(key)), case['result'])
+        self.assertGreater(self.store.cache_database.pttl(key), 0)
         self.store.set(key, 9)
         response, code = self.get_response(request)
         self.assertEqual(response.get('score'), case['result'])
@@ -0,0 +1,15 @@
+#!/bin/sh
+
+PORTS="6381 6382 6383"
+
+if [ "$1" = "stop" ]; then
+    echo "stop"
+    for port in $PORTS; do
+        redis-cli -p $port shutdown nosave
+    done
+else
+    echo "start"
+    for port in $PORTS; do
+        redis-server --port $port --save "" --daemonize yes
+    done
+fi
@@ -0,0 +1,40 @@
+import unittest
+import redis
+from store import Store
+from scoring import get_interests_many
+import json
+
+NODES = [('127.0.0.1', 6381), ('127.0.0.1', 6382), ('127.0.0.1', 6383)]
+
+
+class ShardingTestsSuit(unittest.TestCase):
+
+    def setUp(self):
+        self.store = Store('127.0.0.1', '6381', '6370', 10, 10, 3, nodes=NODES)
+        self.clients = dict(('%s:%s' % node, redis.StrictRedis(*node)) for node in NODES)
+        self.interests = {}
+        for client_id in range(100):
+            self.interests[client_id] = ["cars", "travel"] if client_id % 2 else ["books"]
+            self.store.set('i:%s' % client_id, json.dumps(self.interests[client_id]))
+
+    def tearDown(self):
+        for client in self.clients.values():
+            client.delete(*['i:%s' % client_id for client_id in range(100)])
+
+    def test_keys_live_on_their_ring_node(self):
+        for client_id in range(100):
+            key = 'i:%s' % client_id
+            owner = self.store.node(key)
+            for name, client in self.clients.items():
+                self.assertEqual(client.exists(key), name == owner)
+        self.assertEqual(len([name for name, client in self.clients.items() if client.dbsize()]), len(NODES))
+
+    def test_sharded_get_many(self):
+        client_ids = range(100) + [1000, 1001]
+        interests = get_interests_many(self.store, client_ids)
+        for client_id in client_ids:
+            self.assertEqual(interests[client_id], self.interests.get(client_id, []))
+
+
+if __name__ == "__main__":
+    unittest.main()
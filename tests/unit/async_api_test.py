@@ -0,0 +1,174 @@
+import unittest
+import json
+import socket
+import threading
+import time
+import urllib2
+from concurrent.futures import ThreadPoolExecutor
+import async_api
+import resp_server
+import store
+import trollius as asyncio
+import handler_test
+
+
+class AsyncStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = resp_server.RESPServer(('127.0.0.1', 0))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        port = self.server.server_address[1]
+        self.loop = asyncio.new_event_loop()
+        self.store = async_api.AsyncStore('127.0.0.1', port, port, 1, 1, loop=self.loop)
+
+    def tearDown(self):
+        self.store.close()
+        self.loop.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_pipeline(self):
+        replies = self.run_async(self.store.database.pipeline([('SET', 'a', 1), ('HGET', 'a', 'b'), ('GET', 'a')]))
+        self.assertEqual(replies[0], 'OK')
+        self.assertIsInstance(replies[1], async_api.RedisError)
+        self.assertEqual(replies[2], '1')
+        self.assertEqual(len(self.store.database.idle), 1)
+
+    def test_pipelined_cache_methods(self):
+        self.run_async(self.store.cache_set_many([('uid:1', 1.5, 60), ('uid:2', 3.0, 60)]))
+        self.run_async(self.store.cache_set_many([('uid:1', 9.0, 60)]))
+        self.assertEqual(self.run_async(self.store.cache_get_pipelined(['uid:1', 'uid:2', 'uid:3'])),
+                         {'uid:1': 1.5, 'uid:2': 3.0, 'uid:3': None})
+        self.assertGreater(self.server.database.pttl('uid:1'), 59000)
+        self.run_async(self.store.set('uid:4', 5))
+        self.assertEqual(self.run_async(self.store.get_pipelined(['uid:4', 'uid:5'])), {'uid:4': '5', 'uid:5': None})
+
+    def test_retry_backs_off_and_opens_breaker(self):
+        down = async_api.AsyncStore('127.0.0.1', 1, 1, 1, 3, loop=self.loop, breaker_threshold=3)
+        pauses = []
+        down.retry_pause = lambda attempt: pauses.append(attempt) or 0
+        self.assertIsNone(self.run_async(down.cache_get('uid:1')))
+        self.assertEqual(pauses, [0, 1, 0, 1])
+        self.assertEqual(down.breakers['cache'].state, store.CircuitBreaker.OPEN)
+        self.assertEqual(down.breakers['database'].state, store.CircuitBreaker.OPEN)
+        with self.assertRaises(store.CircuitOpenError):
+            self.run_async(down.set('i:1', 1))
+        down.close()
+
+    def test_cache_get_falls_back_once(self):
+        self.server.database.set('uid:1', '7')
+        split = async_api.AsyncStore('127.0.0.1', self.server.server_address[1], 1, 1, 3, loop=self.loop,
+                                     retry_delay=0)
+        self.assertEqual(self.run_async(split.cache_get('uid:1')), 7)
+        self.assertEqual(split.breakers['cache'].counters['failures'], 3)
+        self.assertEqual(split.breakers['database'].counters['successes'], 1)
+        split.close()
+
+    def test_cancelled_call_stops_retrying(self):
+        hung = socket.socket()
+        hung.bind(('127.0.0.1', 0))
+        hung.listen(5)
+        self.addCleanup(hung.close)
+        port = hung.getsockname()[1]
+        stuck = async_api.AsyncStore('127.0.0.1', port, port, 1, 3, loop=self.loop, retry_delay=0)
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_async(asyncio.wait_for(stuck.get('i:1'), 0.2, loop=self.loop))
+        self.run_async(asyncio.sleep(0.3, loop=self.loop))
+        self.assertEqual(stuck.breakers['database'].counters['failures'], 0)
+        hung.setblocking(False)
+        connections = []
+        while True:
+            try:
+                connections.append(hung.accept()[0])
+            except socket.error:
+                break
+        self.assertEqual(len(connections), 1)
+        stuck.close()
+
+    def test_legacy_envelope_gets_ttl(self):
+        self.server.database.set('uid:1', json.dumps({'value': 2.5, 'time': '01.01.2000 00:00:00'}))
+        self.assertIsNone(self.run_async(self.store.cache_fetch('uid:1')))
+        self.assertFalse(self.server.database.exists('uid:1'))
+        self.server.database.set('uid:2', json.dumps({'value': 2.5, 'time': '01.01.2100 00:00:00'}))
+        self.assertEqual(self.run_async(self.store.cache_get_pipelined(['uid:2'])), {'uid:2': 2.5})
+        self.assertGreater(self.server.database.pttl('uid:2'), 0)
+
+
+class AsyncHTTPServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = resp_server.RESPServer(('127.0.0.1', 0))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.hung = socket.socket()
+        self.hung.bind(('127.0.0.1', 0))
+        self.hung.listen(5)
+
+    def tearDown(self):
+        self.hung.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def start(self, port):
+        loop = asyncio.new_event_loop()
+        async_store = async_api.AsyncStore('127.0.0.1', port, port, 5, 1, loop=loop)
+        server = async_api.AsyncHTTPServer(async_store, ThreadPoolExecutor(2), loop=loop)
+        listener = server.start('127.0.0.1', 0)
+        thread = threading.Thread(target=loop.run_forever)
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            listener.close()
+            loop.run_until_complete(listener.wait_closed())
+            async_store.close()
+            loop.close()
+        self.addCleanup(stop)
+        return server, 'http://127.0.0.1:%s/method' % listener.sockets[0].getsockname()[1]
+
+    def post(self, url, body, headers=None):
+        handler_test.HandlerTest("run").set_valid_auth(body)
+        request = urllib2.Request(url, json.dumps(body), headers or {})
+        try:
+            return json.loads(urllib2.urlopen(request, timeout=5).read())
+        except urllib2.HTTPError as E:
+            return json.loads(E.read())
+
+    def test_method_request(self):
+        self.server.database.set('i:1', json.dumps(['books']))
+        server, url = self.start(self.server.server_address[1])
+        body = {"login": "user", "account": "h&f", "method": "clients_interests",
+                "arguments": {"client_ids": [1]}}
+        response = self.post(url, body)
+        self.assertEqual(response['code'], async_api.OK)
+        self.assertEqual(response['responce'], {'1': ['books']})
+
+    def test_deadline_on_hung_store(self):
+        server, url = self.start(self.hung.getsockname()[1])
+        body = {"login": "user", "account": "h&f", "method": "clients_interests",
+                "arguments": {"client_ids": [1]}}
+        started = time.time()
+        response = self.post(url, body, {'X-Request-Deadline': '200'})
+        self.assertEqual(response['code'], async_api.GATEWAY_TIMEOUT)
+        self.assertLess(time.time() - started, 1)
+
+    def test_bridge_deadline(self):
+        server, url = self.start(self.hung.getsockname()[1])
+        with store.deadline(time.time() + 0.2):
+            with self.assertRaises(store.DeadlineExceeded):
+                server.store.get('i:1')
+        with store.deadline(time.time() - 1):
+            with self.assertRaises(store.DeadlineExceeded):
+                server.store.get('i:1')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+import unittest
+import threading
+import time
+import redis
+import api
+import backends
+import resp_server
+import scoring
+import store
+from field_test import cases
+
+
+class MemoryDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.database = backends.MemoryDatabase()
+
+    @cases([{"value": 'text', "result": 'text'},
+            {"value": u'\u0442\u0435\u043a\u0441\u0442', "result": '\xd1\x82\xd0\xb5\xd0\xba\xd1\x81\xd1\x82'},
+            {"value": 10, "result": '10'},
+            {"value": 1.5, "result": '1.5'},
+            ])
+    def test_memory_set_get(self, case):
+        self.database.set('key', case['value'])
+        self.assertEqual(self.database.get('key'), case['result'])
+
+    def test_memory_set_nx_xx(self):
+        self.assertTrue(self.database.set('key', 1, nx=True))
+        self.assertIsNone(self.database.set('key', 2, nx=True))
+        self.assertIsNone(self.database.set('other', 2, xx=True))
+        self.assertTrue(self.database.set('key', 3, xx=True))
+        self.assertEqual(self.database.mget(['key', 'other']), ['3', None])
+
+    def test_memory_ttl(self):
+        self.database.set('key', 1, px=20)
+        self.assertTrue(0 < self.database.pttl('key') <= 20)
+        self.assertEqual(self.database.pttl('missing'), -2)
+        time.sleep(0.03)
+        self.assertIsNone(self.database.get('key'))
+        self.database.set('key', 1)
+        self.assertEqual(self.database.pttl('key'), -1)
+
+    def test_memory_pipeline(self):
+        self.database.set('a', 1, ex=60)
+        result = self.database.pipeline(transaction=False).get('a').pttl('a').get('b').execute()
+        self.assertEqual(result[0], '1')
+        self.assertGreater(result[1], 0)
+        self.assertIsNone(result[2])
+
+    def test_memory_scan(self):
+        for index in range(25):
+            self.database.set('uid:%d' % index, index)
+        self.database.set('i:1', 1)
+        keys, cursor = [], 0
+        while True:
+            cursor, batch = self.database.scan(cursor, match='uid:*', count=10)
+            keys.extend(batch)
+            if cursor == 0:
+                break
+        self.assertEqual(sorted(keys), sorted('uid:%d' % index for index in range(25)))
+
+
+class RESPServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = resp_server.RESPServer(('127.0.0.1', 0))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = redis.StrictRedis('127.0.0.1', self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_resp_commands(self):
+        self.assertTrue(self.client.ping())
+        self.assertTrue(self.client.set('a', 1.5, px=10000, nx=True))
+        self.assertIsNone(self.client.set('a', 2, nx=True))
+        self.assertEqual(self.client.mget(['a', 'b']), ['1.5', None])
+        self.assertGreater(self.client.pttl('a'), 0)
+        self.assertEqual(self.client.exists('a'), 1)
+        self.assertEqual(self.client.scan(0, match='a*'), (0, ['a']))
+        self.assertEqual(self.client.delete('a', 'b'), 1)
+        with self.assertRaises(redis.ResponseError):
+            self.client.execute_command('HGET', 'a', 'b')
+
+    def test_resp_publish_subscribe(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe('interests')
+        self.assertIsNone(pubsub.get_message(timeout=0.2))
+        self.assertEqual(self.client.publish('interests', 'i:1\ni:2'), 1)
+        message = pubsub.get_message(timeout=1)
+        self.assertEqual((message['channel'], message['data']), ('interests', 'i:1\ni:2'))
+        pubsub.unsubscribe('interests')
+        pubsub.close()
+
+    def test_resp_store(self):
+        port = self.server.server_address[1]
+        resp_store = store.Store('127.0.0.1', port, port, 1, 1, 1)
+        resp_store.set('i:1', '["books"]')
+        self.assertEqual(resp_store.get_many(['i:1', 'i:2']), ['["books"]', None])
+        resp_store.cache_set('uid:1', 3.0, 60)
+        self.assertEqual(resp_store.cache_get('uid:1'), 3.0)
+
+    def test_resp_invalidation_listener_outside_pool(self):
+        port = self.server.server_address[1]
+        resp_store = store.Store('127.0.0.1', port, port, 1, 1, 1, pool_size=1, pool_timeout=1,
+                                 negative_cache_size=100, invalidation_channel='inv')
+        self.assertIsNone(resp_store.get('i:1'))
+        self.assertTrue(resp_store.known_missing('i:1'))
+        for _ in range(100):
+            if self.client.publish('inv', 'i:1'):
+                break
+            time.sleep(0.01)
+        for _ in range(100):
+            if not resp_store.known_missing('i:1'):
+                break
+            time.sleep(0.01)
+        self.assertFalse(resp_store.known_missing('i:1'))
+        self.client.set('i:1', '["books"]')
+        self.assertEqual(resp_store.get('i:1'), '["books"]')
+
+    def test_pool_stats_and_wait(self):
+        port = self.server.server_address[1]
+        client = backends.RedisBackend().connect('127.0.0.1', port, max_connections=1, timeout=0.1)
+        pool = client.connection_pool
+        connection = pool.get_connection('GET')
+        self.assertEqual(backends.RedisBackend().stats(client),
+                         {'max_size': 1, 'in_use': 1, 'idle': 0, 'acquired': 1, 'waits': 0, 'wait_time': 0.0})
+        with self.assertRaises(redis.ConnectionError):
+            client.get('a')
+        threading.Timer(0.2, pool.release, [connection]).start()
+        pool.timeout = 2
+        self.assertIsNone(client.get('a'))
+        stats = pool.stats()
+        self.assertEqual((stats['in_use'], stats['idle'], stats['acquired'], stats['waits']), (0, 1, 3, 2))
+        self.assertGreater(stats['wait_time'], 0.2)
+
+    def test_default_pool_size(self):
+        self.assertEqual(api.default_pool_size(4), 4 + scoring.refreshes.workers)
+        self.assertEqual(api.default_pool_size(1, "background"), 2 + scoring.refreshes.workers)
+
+
+class MemoryStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, local_cache_size=10,
+                                 backend=backends.MemoryBackend())
+
+    def test_memory_store_cache(self):
+        self.assertIsNone(self.store.cache_get('uid:1'))
+        self.store.set('uid:1', 9)
+        self.assertEqual(self.store.cache_get('uid:1'), 9)
+        self.store.cache_set('uid:1', 1.5, 60)
+        self.store.cache_set('uid:1', 2.5, 60)
+        self.assertEqual(self.store.cache_get('uid:1'), 1.5)
+        self.assertEqual(self.store.cache_database.get('uid:1'), '1.5')
+
+    def test_memory_store_shared_by_address(self):
+        backend = backends.MemoryBackend()
+        first = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=backend)
+        second = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=backend)
+        first.set('i:1', '["pets"]')
+        self.assertEqual(second.get('i:1'), '["pets"]')
+        self.assertEqual(second.stats()['pools']['127.0.0.1:6379'], {'keys': 1, 'volatile': 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import threading
+import bulk_score
+import resp_server
+import store
+from field_test import cases
+from scoring import score_key
+
+
+class ParseProfileTest(unittest.TestCase):
+
+    @cases([{"line": '{"phone": "79175002040", "email": "a@b.c"}', "format": 'jsonl',
+             "result": {"phone": "79175002040", "email": "a@b.c"}},
+            {"line": 'a,b,,1\n', "format": 'csv', "result": {"first_name": "a", "last_name": "b", "gender": 1}},
+            {"line": '\n', "format": 'jsonl', "result": None},
+            ])
+    def test_parse_profile(self, case):
+        columns = ['first_name', 'last_name', 'phone', 'gender']
+        self.assertEqual(bulk_score.parse_profile(case['line'], case['format'], columns), case['result'])
+
+    @cases([{"line": 'not json', "format": 'jsonl'},
+            {"line": '[1, 2]', "format": 'jsonl'},
+            {"line": 'a,b,,x', "format": 'csv'},
+            ])
+    def test_parse_bad_profile(self, case):
+        with self.assertRaises(ValueError):
+            bulk_score.parse_profile(case['line'], case['format'], ['first_name', 'last_name', 'phone', 'gender'])
+
+
+class BulkScorerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'profiles.jsonl')
+        self.output = os.path.join(self.directory, 'scores.jsonl')
+        with open(self.path, 'w') as f:
+            for index in range(50):
+                f.write(json.dumps({'id': index, 'phone': '7917500%04d' % index, 'email': 'a@b.c'}) + '\n')
+            f.write('{"phone": "79175002040"}\n')
+            f.write('{"email": "broken", "first_name": "a", "last_name": "b"}\n')
+            f.write('not json\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_output(self):
+        with open(self.output) as f:
+            return [json.loads(line) for line in f]
+
+    def test_run(self):
+        stats = bulk_score.BulkScorer(workers=2, chunk_size=7).run(self.path, self.output)
+        self.assertEqual((stats['records'], stats['scored'], stats['invalid']), (53, 50, 3))
+        self.assertEqual(sum(worker['records'] for worker in stats['workers'].values()), 53)
+        results = self.read_output()
+        self.assertEqual([result['line'] for result in results], range(1, 54))
+        self.assertEqual(results[0], {'line': 1, 'id': 0, 'key': score_key('79175000000'), 'score': 3.0})
+        self.assertEqual([result['error'] for result in results[50:]],
+                         ['Two much null arguments', 'Email format is not valid', 'Malformed record'])
+
+    def test_run_csv_primes_cache(self):
+        server = resp_server.RESPServer(('127.0.0.1', 0))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        port = server.server_address[1]
+        path = os.path.join(self.directory, 'profiles.csv')
+        with open(path, 'w') as f:
+            f.write('first_name,last_name,gender,birthday\na,b,1,25.11.1980\nc,d,,\n')
+        stats = bulk_score.BulkScorer(workers=1, store_args=('127.0.0.1', port, port, 1, 1, 1)).run(
+            path, self.output, 'csv')
+        self.assertEqual((stats['records'], stats['scored']), (2, 2))
+        self.assertEqual([result['score'] for result in self.read_output()], [2.0, 0.5])
+        cache = store.Store('127.0.0.1', port, port, 1, 1, 1)
+        self.assertEqual(cache.cache_get(score_key(None, None, 'c', 'd')), 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -20,5 +20,24 @@ class DeclarativeMethodTest(unittest.TestCase):
         self.assertEqual(Test.__class__.__dict__['a'].label, 'a')
         self.assertEqual(Test.__class__.__dict__['b'].label, 'b')
 
+    def test_compiled_validator(self):
+
+        class UpperField(api.CharField):
+            def validate(self, value):
+                return super(UpperField, self).validate(value).upper()
+
+        class TestRequest(api.Request):
+            name = UpperField(required=True, nullable=False)
+            phone = api.PhoneField(required=False, nullable=True)
+            email = api.EmailField(required=False, nullable=True)
+
+        Test = TestRequest({'name': 'abc', 'phone': 79175002040, 'email': 'bad'})
+        self.assertEqual(Test.name, 'ABC')
+        self.assertEqual(Test.phone, '79175002040')
+        self.assertEqual(Test.email, None)
+        self.assertEqual(Test.errors, ['Email format is not valid'])
+        self.assertEqual(TestRequest({}).errors, ['Field name must be present'])
+        self.assertEqual(TestRequest({'name': ''}).errors, ['Field name must be not nullables'])
+
 if __name__ == "__main__":
     unittest.main()
@@ -2,7 +2,19 @@ import unittest
 import api
 from field_test import cases
 import hashlib
+import httplib
 import datetime
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import backends
+import store
 
 def calculate_key(**kwargs):
     key_parts = [
@@ -95,6 +107,372 @@ class HandlerTest(unittest.TestCase):
         request = {}
         request['body'] = body
         self.assertEqual(api.method_handler(request, {}, store), ('Two much null arguments', 422))
+    def test_batch_handler(self):
+        class Store():
+            def __init__(self):
+                self.writes = []
+
+            def get_pipelined(self, keys):
+                return dict((key, '["books"]' if key.startswith('i:') else None) for key in keys)
+
+            def cache_get_pipelined(self, keys, stale=None):
+                return dict((key, 7) for key in keys)
+
+            def user_value(self, record):
+                return record
+
+            def cache_set_many(self, items):
+                self.writes.extend(items)
+
+        admin = {"login": "admin", "account": "h&f", "method": "online_score", "arguments": {}}
+        user = {"login": "user", "account": "h&f", "method": "online_score",
+                "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        interests = {"login": "user", "account": "h&f", "method": "clients_interests",
+                     "arguments": {"client_ids": [1, 2]}}
+        forbidden = {"login": "user", "token": "sd", "account": "h&f", "method": "online_score", "arguments": {}}
+        for body in (admin, user, interests):
+            self.set_valid_auth(body)
+        store = Store()
+        request = {'body': [admin, user, interests, forbidden, 'not an object']}
+        self.assertEqual(api.batch_handler(request, {}, store), ([
+            {'responce': {'score': 42}, 'code': 200},
+            {'responce': {'score': 7}, 'code': 200},
+            {'responce': {1: [u'books'], 2: [u'books']}, 'code': 200},
+            {'error': 'Forbidden', 'code': 403},
+            {'error': 'Method request must be an object', 'code': 422},
+        ], 200))
+        self.assertEqual(store.writes, [])
+
+    def test_online_score_batch(self):
+        backend_store = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=backends.MemoryBackend())
+        profiles = [{"phone": "79175002040", "email": "stupnikov@otus.ru"},
+                    {"first_name": "a", "last_name": "b"},
+                    {"phone": "79175002040"},
+                    {"email": "not an email", "first_name": "a", "last_name": "b"}]
+        body = {"login": "user", "account": "h&f", "method": "online_score_batch",
+                "arguments": {"profiles": profiles}}
+        self.set_valid_auth(body)
+        ctx = {}
+        self.assertEqual(api.method_handler({'body': body}, ctx, backend_store), ([
+            {'responce': {'score': 3.0}, 'code': 200},
+            {'responce': {'score': 0.5}, 'code': 200},
+            {'error': 'Two much null arguments', 'code': 422},
+            {'error': 'Email format is not valid\r\n', 'code': 422},
+        ], 200))
+        self.assertEqual(ctx['nprofiles'], 4)
+        self.assertEqual(backend_store.cache_get(api.score_key(None, None, 'a', 'b')), 0.5)
+        body['login'] = 'admin'
+        self.set_valid_auth(body)
+        self.assertEqual(api.method_handler({'body': body}, {}, backend_store),
+                         ([{'responce': {'score': 42}, 'code': 200}] * 4, 200))
+
+    @cases([{"profiles": {}}, {"profiles": [1]}, {}])
+    def test_online_score_batch_invalid(self, arguments):
+        body = {"login": "user", "account": "h&f", "method": "online_score_batch", "arguments": arguments}
+        self.set_valid_auth(body)
+        self.assertEqual(api.method_handler({'body': body}, {}, None)[1], 422)
+
+    def test_batch_handler_not_array(self):
+        self.assertEqual(api.batch_handler({'body': {}}, {}, None),
+                         ('Batch must be an array of method requests', 422))
+
+
+
+class AuthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.verified_tokens = api.verified_tokens
+        api.verified_tokens = store.LocalCache(10, 60)
+
+    def tearDown(self):
+        api.verified_tokens = self.verified_tokens
+
+    def request(self, login, token):
+        return api.MethodRequest({"account": "h&f", "login": login, "token": token,
+                                  "method": "online_score", "arguments": {}})
+
+    def test_user_token_cached(self):
+        token = hashlib.sha512("h&f" + "user" + api.SALT).hexdigest()
+        self.assertTrue(api.check_auth(self.request("user", token)))
+        self.assertTrue(api.check_auth(self.request("user", unicode(token))))
+        self.assertEqual((api.verified_tokens.hits, len(api.verified_tokens.entries)), (1, 1))
+
+    @cases(["sd", u"\u0442\u043e\u043a\u0435\u043d", ""])
+    def test_bad_token_not_cached(self, token):
+        self.assertFalse(api.check_auth(self.request("user", token)))
+        self.assertFalse(api.check_auth(self.request("admin", token)))
+        self.assertEqual(len(api.verified_tokens.entries), 0)
+
+    def test_admin_digests_rotate(self):
+        digests = api.AdminDigests(api.ADMIN_SALT)
+        hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+        self.assertEqual(digests.current(), digests.digest(hour))
+        next_digest = digests.hours[1][1]
+        digests.hours = [(time.time() - 1, 'expired'), digests.hours[1]]
+        digests.rotate()
+        self.assertEqual(digests.hours[0][1], digests.digest(hour))
+        self.assertEqual(next_digest, digests.digest(hour + datetime.timedelta(hours=1)))
+        self.assertTrue(digests.timer.daemon)
+        digests.timer.cancel()
+
+    def test_admin_digests_start_one_timer(self):
+        digests = api.AdminDigests(api.ADMIN_SALT)
+        rotate, rotations = digests.rotate, []
+
+        def slow_rotate():
+            rotations.append(threading.current_thread().name)
+            time.sleep(0.05)
+            rotate()
+        digests.rotate = slow_rotate
+        callers = [threading.Thread(target=digests.current) for _ in range(4)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join()
+        self.assertEqual(len(rotations), 1)
+        digests.timer.cancel()
+
+    def test_admin_token(self):
+        token = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+        self.assertTrue(api.check_auth(self.request("admin", token)))
+
+
+class ReadinessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = api.HTTPServer(('127.0.0.1', 0), api.MainHTTPHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/ready' % self.server.server_address[1]
+        self.path = tempfile.mktemp()
+        self.store = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, local_cache_size=10,
+                                 backend=backends.MemoryBackend())
+        api.MainHTTPHandler.ready.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        api.MainHTTPHandler.ready.set()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def get_ready(self):
+        try:
+            return urllib2.urlopen(self.url).getcode()
+        except urllib2.HTTPError as E:
+            return E.code
+
+    def test_ready_after_warming(self):
+        with open(self.path, 'w') as f:
+            json.dump(['uid:1'], f)
+        self.store.set('uid:1', 7)
+        self.assertEqual(self.get_ready(), api.SERVICE_UNAVAILABLE)
+        api.prepare(self.store, self.path, "sync")
+        self.assertEqual(self.get_ready(), api.OK)
+        self.assertEqual(self.store.local_get('uid:1'), 7)
+
+    def test_stats(self):
+        self.store = api.MainHTTPHandler.store
+        self.addCleanup(setattr, api.MainHTTPHandler, 'store', self.store)
+        api.MainHTTPHandler.store = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, local_cache_size=10,
+                                                backend=backends.RedisBackend())
+        api.MainHTTPHandler.store.local_get('uid:1')
+        url = self.url.replace('/ready', '/stats')
+        stats = json.loads(urllib2.urlopen(url).read())
+        self.assertEqual(stats['pid'], os.getpid())
+        self.assertEqual(stats['local_cache']['misses'], 1)
+        self.assertEqual(stats['breakers']['database']['state'], 'closed')
+        self.assertEqual(sorted(stats['pools']['cache']),
+                         ['acquired', 'idle', 'in_use', 'max_size', 'wait_time', 'waits'])
+        self.assertIn('coalesced', stats['flights'])
+        self.assertIn('dropped', stats['refreshes'])
+
+    def test_ready_without_snapshot(self):
+        api.prepare(self.store, self.path, "background")
+        self.assertEqual(self.get_ready(), api.OK)
+
+
+
+class KeepAliveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timeout = api.MainHTTPHandler.timeout
+        api.MainHTTPHandler.timeout = 0.5
+        api.MainHTTPHandler.ready.set()
+
+    def tearDown(self):
+        api.MainHTTPHandler.timeout = self.timeout
+
+    def start(self, server):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address[1]
+
+    def get(self, port):
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=2)
+        connection.request('GET', '/ready')
+        response = connection.getresponse()
+        response.read()
+        return connection, response
+
+    @cases([{"server": lambda: api.HTTPServer(('127.0.0.1', 0), api.MainHTTPHandler), "connection": 'close'},
+            {"server": lambda: api.ThreadPoolHTTPServer(('127.0.0.1', 0), api.MainHTTPHandler, 1),
+             "connection": None},
+            ])
+    def test_idle_connection_does_not_block(self, case):
+        port = self.start(case['server']())
+        idle, response = self.get(port)
+        self.assertEqual(response.getheader('Connection'), case['connection'])
+        started = time.time()
+        other, response = self.get(port)
+        self.assertEqual(response.status, api.OK)
+        self.assertLess(time.time() - started, 1.5)
+        idle.close()
+        other.close()
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = api.MainHTTPHandler.store
+        api.MainHTTPHandler.store = store.Store('127.0.0.1', '1', '1', 1, 1, 3, retry_delay=1)
+        self.server = api.HTTPServer(('127.0.0.1', 0), api.MainHTTPHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/method' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        api.MainHTTPHandler.store = self.store
+
+    def post(self, body, headers):
+        request = urllib2.Request(self.url, json.dumps(body), headers)
+        try:
+            return json.loads(urllib2.urlopen(request).read())
+        except urllib2.HTTPError as E:
+            return json.loads(E.read())
+
+    def test_deadline_header(self):
+        body = {"login": "user", "account": "h&f", "method": "online_score",
+                "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        HandlerTest('run').set_valid_auth(body)
+        started = time.time()
+        self.assertEqual(self.post(body, {'X-Request-Deadline': '100'}),
+                         {'error': 'Gateway Timeout', 'code': api.GATEWAY_TIMEOUT})
+        self.assertLess(time.time() - started, 0.5)
+
+
+class ServerModesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = api.MainHTTPHandler.store
+        api.MainHTTPHandler.ready.set()
+        self.body = {"login": "user", "account": "h&f", "method": "clients_interests",
+                     "arguments": {"client_ids": [1, 2]}}
+        HandlerTest('run').set_valid_auth(self.body)
+
+    def tearDown(self):
+        api.MainHTTPHandler.store = self.store
+
+    def post(self, port):
+        request = urllib2.Request('http://127.0.0.1:%s/method' % port, json.dumps(self.body))
+        return json.loads(urllib2.urlopen(request, timeout=5).read())
+
+    def test_thread_pool_serves_requests_concurrently(self):
+        slow = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=backends.MemoryBackend())
+        threads = set()
+        get_many = slow.get_many
+
+        def slow_get_many(keys):
+            threads.add(threading.current_thread().name)
+            time.sleep(0.2)
+            return get_many(keys)
+        slow.get_many = slow_get_many
+        api.MainHTTPHandler.store = slow
+        server = api.ThreadPoolHTTPServer(('127.0.0.1', 0), api.MainHTTPHandler, 4)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        responses = []
+        clients = [threading.Thread(target=lambda: responses.append(self.post(server.server_address[1])))
+                   for _ in range(4)]
+        started = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        self.assertLess(time.time() - started, 0.6)
+        self.assertEqual([response['code'] for response in responses], [api.OK] * 4)
+        self.assertEqual(len(threads), 4)
+
+    @cases([{"platform": "linux2", "option": 15}, {"platform": "darwin", "option": None}])
+    def test_reuse_port_option_without_constant(self, case):
+        option, platform = getattr(socket, 'SO_REUSEPORT', None), sys.platform
+        if option is not None:
+            del socket.SO_REUSEPORT
+        sys.platform = case['platform']
+        try:
+            self.assertEqual(api.reuse_port_option(), case['option'])
+            if case['option'] is None:
+                with self.assertRaises(ValueError):
+                    api.reuse_port_server(('127.0.0.1', 0))
+        finally:
+            sys.platform = platform
+            if option is not None:
+                socket.SO_REUSEPORT = option
+
+    def test_prefork_workers_build_their_own_stores(self):
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        read, write = os.pipe()
+        supervisor = os.fork()
+        if supervisor == 0:
+            os.close(read)
+            create_store = api.create_store
+
+            def report_store(**options):
+                os.write(write, '%s\n' % os.getpid())
+                return create_store(**options)
+            api.create_store = report_store
+            try:
+                api.serve_prefork(('127.0.0.1', port), 2, {"backend": backends.MemoryBackend()}, {}, threads=2)
+            finally:
+                os._exit(0)
+        os.close(write)
+        try:
+            for _ in range(50):
+                try:
+                    responses = [self.post(port) for _ in range(4)]
+                    break
+                except urllib2.URLError:
+                    time.sleep(0.1)
+            self.assertEqual([response['code'] for response in responses], [api.OK] * 4)
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout=2)
+            for _ in range(2):
+                connection.request('GET', '/ready')
+                response = connection.getresponse()
+                response.read()
+                self.assertEqual(response.status, api.OK)
+                self.assertIsNone(response.getheader('Connection'))
+            connection.close()
+        finally:
+            os.kill(supervisor, signal.SIGINT)
+            os.waitpid(supervisor, 0)
+        with os.fdopen(read) as reports:
+            workers = reports.read().split()
+        self.assertEqual(len(set(workers)), 2)
+        self.assertNotIn(str(supervisor), workers)
+
 
 if __name__ == "__main__":
     unittest.main()
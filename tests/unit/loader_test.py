@@ -0,0 +1,127 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import backends
+import loader
+import scoring
+import store
+from field_test import cases
+from scoring import get_interests_many
+
+
+class ParseRecordTest(unittest.TestCase):
+
+    @cases([{"line": '{"client_id": 1, "interests": ["books", "pets"]}', "format": 'jsonl',
+             "result": (1, ["books", "pets"])},
+            {"line": '2,cars|travel\n', "format": 'csv', "result": (2, ["cars", "travel"])},
+            {"line": '3,', "format": 'csv', "result": (3, [])},
+            {"line": 'client_id,interests', "format": 'csv', "result": None},
+            {"line": '\n', "format": 'jsonl', "result": None},
+            ])
+    def test_parse_record(self, case):
+        self.assertEqual(loader.parse_record(case['line'], case['format']), case['result'])
+
+    @cases([{"line": '{"client_id": "x", "interests": []}', "format": 'jsonl'},
+            {"line": '{"client_id": 1, "interests": "books"}', "format": 'jsonl'},
+            {"line": '{"client_id": 1}', "format": 'jsonl'},
+            {"line": 'x,books', "format": 'csv'},
+            ])
+    def test_parse_bad_record(self, case):
+        with self.assertRaises((ValueError, KeyError)):
+            loader.parse_record(case['line'], case['format'])
+
+
+class Failing(object):
+
+    def __init__(self, store, fail_after):
+        self.store = store
+        self.fail_after = fail_after
+
+    def set_many(self, items):
+        if self.fail_after <= 0:
+            raise IOError('down')
+        self.fail_after -= 1
+        return self.store.set_many(items)
+
+
+class LoaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'interests.jsonl')
+        self.checkpoint = os.path.join(self.directory, 'interests.checkpoint')
+        with open(self.path, 'w') as f:
+            for client_id in range(95):
+                f.write(json.dumps({'client_id': client_id, 'interests': ['i%d' % client_id]}) + '\n')
+            f.write('not json\n')
+        self.store = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=backends.MemoryBackend())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertLoaded(self):
+        interests = get_interests_many(self.store, range(95))
+        self.assertEqual(interests, dict((client_id, ['i%d' % client_id]) for client_id in range(95)))
+
+    def test_load(self):
+        stats = loader.Loader(self.store, batch_size=10, workers=3, checkpoint=self.checkpoint).load(self.path)
+        self.assertEqual((stats['records'], stats['skipped'], stats['failed']), (95, 1, False))
+        self.assertEqual(stats['offset'], os.path.getsize(self.path))
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertLoaded()
+
+    def test_load_compact(self):
+        scoring.vocabularies.clear()
+        stats = loader.Loader(self.store, batch_size=10, compact=True).load(self.path)
+        self.assertEqual((stats['records'], stats['failed']), (95, False))
+        self.assertTrue(self.store.get('i:5').startswith(scoring.COMPACT_MARKER))
+        self.assertEqual(self.store.get(scoring.VOCABULARY_KEY), '95')
+        self.assertLoaded()
+
+    def test_load_writes_bloom_filter(self):
+        bloom_path = os.path.join(self.directory, 'interests.bloom')
+        loader.Loader(self.store, batch_size=10, bloom_path=bloom_path, bloom_capacity=1000).load(self.path)
+        bloom = store.BloomFilter.load(bloom_path)
+        self.assertTrue(all('i:%d' % client_id in bloom for client_id in range(95)))
+
+    def test_bloom_filter_survives_failure_and_delta_load(self):
+        bloom_path = os.path.join(self.directory, 'interests.bloom')
+        failing = loader.Loader(Failing(self.store, 3), batch_size=10, workers=1, checkpoint=self.checkpoint,
+                                checkpoint_interval=0, bloom_path=bloom_path, bloom_capacity=1000)
+        self.assertTrue(failing.load(self.path)['failed'])
+        bloom = store.BloomFilter.load(bloom_path)
+        self.assertTrue(all('i:%d' % client_id in bloom for client_id in range(30)))
+        loader.Loader(self.store, batch_size=10, checkpoint=self.checkpoint, bloom_path=bloom_path).load(self.path)
+        delta = os.path.join(self.directory, 'delta.jsonl')
+        with open(delta, 'w') as f:
+            f.write(json.dumps({'client_id': 1000, 'interests': ['new']}) + '\n')
+        loader.Loader(self.store, bloom_path=bloom_path).load(delta)
+        bloom = store.BloomFilter.load(bloom_path)
+        self.assertTrue(all('i:%d' % client_id in bloom for client_id in range(95) + [1000]))
+        bloomed = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, bloom=bloom, backend=self.store.backend)
+        self.assertEqual(bloomed.get('i:5'), '["i5"]')
+
+    def test_resume_without_bloom_filter(self):
+        self.assertTrue(loader.Loader(Failing(self.store, 3), batch_size=10, workers=1,
+                                      checkpoint=self.checkpoint).load(self.path)['failed'])
+        with self.assertRaises(ValueError):
+            loader.Loader(self.store, checkpoint=self.checkpoint,
+                          bloom_path=os.path.join(self.directory, 'interests.bloom')).load(self.path)
+
+    def test_resume_after_failure(self):
+        failing = loader.Loader(Failing(self.store, 3), batch_size=10, workers=1, checkpoint=self.checkpoint)
+        stats = failing.load(self.path)
+        self.assertTrue(stats['failed'])
+        self.assertEqual(stats['records'], 30)
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['records'], 30)
+        self.store.database.flushdb()
+        stats = loader.Loader(self.store, batch_size=10, workers=2, checkpoint=self.checkpoint).load(self.path)
+        self.assertEqual((stats['records'], stats['failed']), (95, False))
+        self.assertEqual(self.store.database.dbsize(), 65)
+
+
+if __name__ == "__main__":
+    unittest.main()
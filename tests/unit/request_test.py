@@ -17,7 +17,7 @@ class RequestTests(unittest.TestCase):
 
         Request = TestRequest(case)
         for key in case.keys():
-            self.assertEqual(Request.__dict__[key], case[key])
+            self.assertEqual(getattr(Request, key), case[key])
         self.assertEqual(Request.is_valid, True)
 
 
@@ -30,10 +30,54 @@ class RequestTests(unittest.TestCase):
                 locals()[key] = api.CharField(required=True, nullable=False)
 
         Request = TestRequest(case['req'])
-        self.assertEqual(Request.__dict__['errors'], case['err'])
+        self.assertEqual(Request.errors, case['err'])
         self.assertEqual(Request.is_valid, False)
 
 
+    @cases([{'req': {'value': 23, 'value_1': 30}, 'err': 1},
+            {'req': {'value': 'a', 'value_1': 30}, 'err': 1},
+            {'req': {'value': 'a', 'value_1': 'b'}, 'err': 0}])
+    def test_request_fail_fast(self, case):
+        class TestRequest(api.Request):
+            fail_fast = True
+            value = api.CharField(required=True, nullable=False)
+            value_1 = api.CharField(required=True, nullable=False)
+
+        Request = TestRequest(case['req'])
+        self.assertEqual(len(Request.errors), case['err'])
+        self.assertEqual(Request.is_valid, not case['err'])
+
+    def test_fail_fast_checks_birthday_last(self):
+        class TestRequest(api.Request):
+            fail_fast = True
+            birthday = api.BirthDayField(required=False, nullable=True)
+            phone = api.PhoneField(required=False, nullable=True)
+
+        Request = TestRequest({'birthday': '01.01.1900', 'phone': '123'})
+        self.assertEqual(Request.errors, ['Phone number not valid'])
+        self.assertEqual(Request.birthday, None)
+        Request = TestRequest({'birthday': '01.01.1900', 'phone': '79175002040'})
+        self.assertEqual(Request.errors, ['\xd0\xa1lient has been born for more than 70 years'])
+
+    def test_client_ids_max_length(self):
+        self.assertTrue(api.ClientsInterestsRequest({'client_ids': range(api.MAX_CLIENT_IDS + 1)}).is_valid)
+        field = api.ClientsInterestsRequest.client_ids
+        field.max_length = api.client_ids_limit(fail_fast=True)
+        try:
+            request = api.ClientsInterestsRequest({'client_ids': range(api.MAX_CLIENT_IDS + 1)})
+            self.assertEqual(request.errors, ['Client ids field has more than %s items' % api.MAX_CLIENT_IDS])
+            request = api.ClientsInterestsRequest({'client_ids': range(api.MAX_CLIENT_IDS)})
+            self.assertTrue(request.is_valid)
+        finally:
+            field.max_length = None
+
+    @cases([{"limit": None, "fail_fast": False, "max_length": None},
+            {"limit": None, "fail_fast": True, "max_length": api.MAX_CLIENT_IDS},
+            {"limit": 50, "fail_fast": False, "max_length": 50},
+            {"limit": 50, "fail_fast": True, "max_length": 50}])
+    def test_client_ids_limit(self, case):
+        self.assertEqual(api.client_ids_limit(case['limit'], case['fail_fast']), case['max_length'])
+
     @cases([{"login": "horns&hoofs", 'is_admin': False},
             {"login": "admin", 'is_admin': True}])
     def test_admin_method_request(self, case):
@@ -1,8 +1,17 @@
+import socket
 import store
+import scoring
+import resp_server
+import backends
+import threading
+import tempfile
+import os
 import unittest
 from field_test import cases
 import hashlib
 import json
+import time
+import datetime
 
 def calculate_key(key_parts):
     key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
@@ -58,6 +67,676 @@ class StoreTest(unittest.TestCase):
         self.assertEqual(self.store.cache_get(self.key), None)
         self.store = store.Store('127.0.0.1', '6379', '6370', 10, 10, 3)
 
+class CacheRecordTest(unittest.TestCase):
+
+    def legacy(self, seconds, value):
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+        return json.dumps({'value': value, 'time': expires.strftime(store.LEGACY_TIME_FORMAT)})
+
+    @cases([{"record": None, "pttl": -2, "result": None},
+            {"record": '3.5', "pttl": 1500, "result": 3.5, "ttl": 1.5},
+            {"record": '9', "pttl": -1, "result": 9, "ttl": float('inf')},
+            ])
+    def test_decode_native_record(self, case):
+        value, ttl = store.decode_cache_record(case['record'], case['pttl'])
+        self.assertEqual(value, case['result'])
+        if 'ttl' in case:
+            self.assertEqual(ttl, case['ttl'])
+
+    def test_decode_legacy_record(self):
+        value, ttl = store.decode_cache_record(self.legacy(60, 1.5))
+        self.assertEqual(value, 1.5)
+        self.assertTrue(0 < ttl <= 60)
+        self.assertEqual(store.decode_cache_record(self.legacy(-60, 1.5)), (None, 0))
+
+
+class CacheWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=backends.MemoryBackend())
+        self.cache = self.store.cache_database
+
+    def legacy(self, seconds, value):
+        return CacheRecordTest('run').legacy(seconds, value)
+
+    def test_set_nx(self):
+        self.store.cache_set('uid:1', 1.5, 60)
+        self.store.cache_set('uid:1', 2.5, 60)
+        self.store.cache_set_many([('uid:1', 3.5, 60), ('uid:2', 4.5, 60)])
+        self.assertEqual(self.cache.mget(['uid:1', 'uid:2']), ['1.5', '4.5'])
+        self.assertTrue(59000 < self.cache.pttl('uid:2') <= 60000)
+
+    @cases([{"pipelined": False}, {"pipelined": True}])
+    def test_expired_legacy_record_is_replaced(self, case):
+        self.cache.set('uid:1', self.legacy(-60, 9))
+        self.cache.set('uid:2', self.legacy(60, 7))
+        if case['pipelined']:
+            self.assertEqual(self.store.cache_get_pipelined(['uid:1', 'uid:2']), {'uid:1': None, 'uid:2': 7})
+        else:
+            self.assertEqual([self.store.cache_get('uid:1'), self.store.cache_get('uid:2')], [None, 7])
+        self.assertTrue(0 < self.cache.pttl('uid:2') <= 60000)
+        self.store.cache_set('uid:1', 3.0, 60)
+        self.assertEqual(self.store.cache_get('uid:1'), 3.0)
+
+
+class Flaky(object):
+    trys = 3
+
+    def __init__(self, failures, threshold=5):
+        self.calls = 0
+        self.failures = failures
+        self.breakers = {'database': store.CircuitBreaker('database', threshold, 60)}
+
+    def retry_pause(self, attempt):
+        return 0
+
+    @store.retry()
+    def call(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise IOError('down')
+        return 'ok'
+
+
+class RetryTest(unittest.TestCase):
+
+    def test_retry_recovers(self):
+        flaky = Flaky(2)
+        self.assertEqual(flaky.call(), 'ok')
+        self.assertEqual(flaky.calls, 3)
+        self.assertEqual(flaky.breakers['database'].state, store.CircuitBreaker.CLOSED)
+
+    def test_retry_gives_up(self):
+        flaky = Flaky(3)
+        with self.assertRaises(IOError):
+            flaky.call()
+        self.assertEqual(flaky.calls, 3)
+
+    def test_open_circuit_fails_fast(self):
+        flaky = Flaky(10, threshold=2)
+        with self.assertRaises(IOError):
+            flaky.call()
+        self.assertEqual(flaky.calls, 2)
+        self.assertEqual(flaky.breakers['database'].state, store.CircuitBreaker.OPEN)
+        with self.assertRaises(store.CircuitOpenError):
+            flaky.call()
+        self.assertEqual(flaky.calls, 2)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_breaker_half_open_probe(self):
+        breaker = store.CircuitBreaker('cache', 1, 0.01)
+        breaker.failure()
+        self.assertEqual(breaker.state, store.CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, store.CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, store.CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.stats()['opened'], 1)
+
+    def test_breaker_reopens_on_failed_probe(self):
+        breaker = store.CircuitBreaker('cache', 1, 0.01)
+        breaker.failure()
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, store.CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+
+class HashRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = ['127.0.0.1:6381', '127.0.0.1:6382', '127.0.0.1:6383']
+        self.keys = ['i:%d' % cid for cid in range(3000)]
+
+    def test_ring_distribution(self):
+        ring = store.HashRing(self.nodes)
+        counts = dict((node, 0) for node in self.nodes)
+        for key in self.keys:
+            counts[ring.get_node(key)] += 1
+        for node in self.nodes:
+            self.assertGreater(counts[node], len(self.keys) / 6)
+
+    def test_ring_stability(self):
+        ring = store.HashRing(self.nodes)
+        grown = store.HashRing(self.nodes + ['127.0.0.1:6384'])
+        moved = [key for key in self.keys if ring.get_node(key) != grown.get_node(key)]
+        self.assertTrue(all(grown.get_node(key) == '127.0.0.1:6384' for key in moved))
+        self.assertLess(len(moved), len(self.keys) / 2)
+
+    def test_store_groups_keys_by_node(self):
+        sharded = store.Store('127.0.0.1', '6381', '6370', 10, 10, 3,
+                              nodes=[('127.0.0.1', 6381), ('127.0.0.1', 6382), ('127.0.0.1', 6383)],
+                              replicas={'127.0.0.1:6381': [('127.0.0.1', 6391)]})
+        groups = sharded.group(self.keys)
+        self.assertEqual(sorted(groups.keys()), self.nodes)
+        self.assertEqual(sum(len(keys) for keys in groups.values()), len(self.keys))
+        for node, keys in groups.items():
+            self.assertTrue(all(sharded.node(key) == node for key in keys))
+        self.assertEqual(sharded.shards['127.0.0.1:6381'].reader(),
+                         sharded.shards['127.0.0.1:6381'].replicas[0])
+
+    @cases([{"nodes": None}, {"nodes": [('127.0.0.1', 6381), ('127.0.0.1', 6382), ('127.0.0.1', 6383)]}])
+    def test_chunked_get_many(self, case):
+        chunked = store.Store('127.0.0.1', '6381', '6370', 10, 10, 1, chunk_size=3, backend=backends.MemoryBackend(),
+                              nodes=case['nodes'])
+        chunks = []
+        for shard in chunked.shards.values():
+            def mget(keys, mget=shard.primary.mget):
+                chunks.append(len(keys))
+                return mget(keys)
+            shard.primary.mget = mget
+        keys = self.keys[:40]
+        chunked.set_many([(key, index) for index, key in enumerate(keys) if index % 4])
+        expected = [str(index) if index % 4 else None for index in range(len(keys))]
+        self.assertEqual(chunked.get_many(keys), expected)
+        self.assertEqual(sum(chunks), len(keys))
+        self.assertTrue(all(chunk <= 3 for chunk in chunks))
+        self.assertGreater(len(chunks), len(chunked.shards))
+
+    def test_parallel_does_not_queue_callers(self):
+        sharded = store.Store('127.0.0.1', '6381', '6370', 10, 10, 3, pool_size=8, backend=backends.MemoryBackend(),
+                              nodes=[('127.0.0.1', 6381), ('127.0.0.1', 6382), ('127.0.0.1', 6383)])
+        caller_threads = []
+
+        def read(group):
+            time.sleep(0.1)
+            return group, threading.current_thread().name, store.remaining() is not None
+
+        def call():
+            with store.deadline(time.time() + 10):
+                results = sharded.parallel(read, ['a', 'b', 'c'])
+            caller_threads.append((threading.current_thread().name, results))
+        started = time.time()
+        callers = [threading.Thread(target=call) for _ in range(8)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join()
+        self.assertLess(time.time() - started, 0.5)
+        for name, results in caller_threads:
+            self.assertEqual([group for group, thread, bounded in results], ['a', 'b', 'c'])
+            self.assertEqual(results[0][1], name)
+            self.assertTrue(all(bounded for group, thread, bounded in results))
+
+
+class LocalCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = store.LocalCache(2, 60)
+
+    def test_local_cache_get_set(self):
+        self.cache.set('a', 1, 10)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.stats(), {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_local_cache_lru_eviction(self):
+        self.cache.set('a', 1, 10)
+        self.cache.set('b', 2, 10)
+        self.cache.get('a')
+        self.cache.set('c', 3, 10)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_local_cache_ttl(self):
+        self.cache.set('a', 1, 0.01)
+        time.sleep(0.02)
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.set('b', 2, 0)
+        self.assertEqual(self.cache.get('b'), None)
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = store.SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def lookup(self, value):
+        self.calls += 1
+        self.release.wait(1)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def run_concurrently(self, value, count=5):
+        results = []
+
+        def worker():
+            try:
+                results.append(self.flights.do('uid:1', self.lookup, value))
+            except IOError as E:
+                results.append(E)
+        threads = [threading.Thread(target=worker) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        while self.flights.coalesced < count - 1:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single_flight_coalesces(self):
+        self.assertEqual(self.run_concurrently(3.0), [3.0] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flights.stats(), {'in_flight': 0, 'coalesced': 4})
+
+    def test_single_flight_shares_error(self):
+        error = IOError('down')
+        self.assertEqual(self.run_concurrently(error), [error] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flights.do('uid:1', lambda: 1), 1)
+
+
+class CacheLockTest(unittest.TestCase):
+
+    def setUp(self):
+        backend = backends.MemoryBackend()
+        self.first = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=backend, cache_lock_timeout=1)
+        self.second = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=backend, cache_lock_timeout=1)
+
+    def test_cache_miss_waits_for_lock_holder(self):
+        self.assertIsNone(self.first.cache_get('uid:1'))
+        self.assertFalse(self.second.cache_lock('uid:1'))
+        timer = threading.Timer(0.05, self.first.cache_set, ('uid:1', 2.5, 60))
+        timer.start()
+        self.assertEqual(self.second.cache_get('uid:1'), 2.5)
+        timer.join()
+        self.assertTrue(self.second.cache_lock('uid:2'))
+        self.assertIsNone(self.first.cache_database.get('lock:uid:1'))
+
+    def test_primary_hit_frees_lock(self):
+        self.first.set('uid:1', 7)
+        self.assertEqual(self.first.cache_get('uid:1'), 7)
+        self.assertIsNone(self.first.cache_database.get('lock:uid:1'))
+        started = time.time()
+        self.assertEqual(self.second.cache_get('uid:1'), 7)
+        self.assertLess(time.time() - started, 0.5)
+
+    def test_cache_lock_wait_is_bounded(self):
+        self.first.cache_lock_timeout = self.second.cache_lock_timeout = 0.05
+        self.assertIsNone(self.first.cache_get('uid:1'))
+        started = time.time()
+        self.assertIsNone(self.second.cache_get('uid:1'))
+        self.assertLess(time.time() - started, 0.5)
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_bloom_membership(self):
+        bloom = store.BloomFilter.for_capacity(1000, 0.01)
+        for cid in range(1000):
+            bloom.add('i:%d' % cid)
+        self.assertTrue(all('i:%d' % cid in bloom for cid in range(1000)))
+        false_positives = len([cid for cid in range(1000, 11000) if 'i:%d' % cid in bloom])
+        self.assertLess(false_positives, 300)
+
+    def test_bloom_save_load(self):
+        bloom = store.BloomFilter.for_capacity(100)
+        bloom.add('i:1')
+        path = tempfile.mktemp()
+        bloom.save(path)
+        loaded = store.BloomFilter.load(path)
+        os.remove(path)
+        self.assertEqual((loaded.size, loaded.hashes, loaded.bits), (bloom.size, bloom.hashes, bloom.bits))
+        self.assertTrue('i:1' in loaded)
+
+
+class Counting(backends.MemoryBackend):
+
+    def __init__(self):
+        backends.MemoryBackend.__init__(self)
+        self.reads = 0
+
+    def connect(self, host, port, **options):
+        database = backends.MemoryBackend.connect(self, host, port, **options)
+        backend = self
+
+        class CountingDatabase(object):
+            def __getattr__(self, name):
+                if name in ('get', 'mget'):
+                    backend.reads += 1
+                return getattr(database, name)
+        return CountingDatabase()
+
+
+class NegativeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = Counting()
+        self.store = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=self.backend,
+                                 negative_cache_size=10, negative_cache_ttl=60)
+
+    def test_missing_key_answered_locally(self):
+        self.assertIsNone(self.store.get('i:1'))
+        self.assertEqual(self.store.get_many(['i:1', 'i:2']), [None, None])
+        self.assertEqual(self.store.get_many(['i:1', 'i:2']), [None, None])
+        self.assertIsNone(self.store.get('i:2'))
+        self.assertEqual(self.backend.reads, 2)
+        self.assertEqual(self.store.stats()['negative_cache']['hits'], 4)
+
+    def test_negative_cache_scoped_to_prefix(self):
+        self.store.get('uid:1')
+        self.store.get('uid:1')
+        self.assertEqual(self.backend.reads, 2)
+
+    def test_set_invalidates(self):
+        self.store.get('i:1')
+        self.store.set('i:1', '["pets"]')
+        self.assertEqual(self.store.get('i:1'), '["pets"]')
+
+    def test_bloom_prescreens(self):
+        bloom = store.BloomFilter.for_capacity(100)
+        bloom.add('i:1')
+        self.store.bloom = bloom
+        self.store.set('i:1', '["pets"]')
+        self.assertEqual(self.store.get_many(['i:1', 'i:2', 'i:3']), ['["pets"]', None, None])
+        self.assertEqual(self.backend.reads, 1)
+        self.store.set('i:2', '["cars"]')
+        self.assertEqual(self.store.get('i:2'), '["cars"]')
+
+    def test_invalidation_channel(self):
+        listener = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=self.backend,
+                               negative_cache_size=10, invalidation_channel='interests')
+        writer = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=self.backend,
+                             invalidation_channel='interests')
+        time.sleep(0.05)
+        self.assertIsNone(listener.get('i:1'))
+        writer.set_many([('i:1', '["pets"]'), ('i:2', '["cars"]')])
+        for _ in range(100):
+            if listener.get('i:1') is not None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(listener.get('i:1'), '["pets"]')
+
+
+class HotKeysTest(unittest.TestCase):
+
+    def test_hot_keys_top(self):
+        hot_keys = store.HotKeys(2)
+        hot_keys.record(['uid:1', 'uid:2', 'uid:1', 'uid:3', 'uid:1', 'uid:2'])
+        self.assertEqual(hot_keys.top(), ['uid:1', 'uid:2'])
+        hot_keys.record(['uid:%d' % index for index in range(4, 10)])
+        self.assertLessEqual(len(hot_keys.counts), 4)
+        self.assertEqual(hot_keys.top(1), ['uid:1'])
+
+    def test_store_warm(self):
+        backend = backends.MemoryBackend()
+        warm = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, local_cache_size=10, hot_keys_size=10,
+                           backend=backend)
+        warm.cache_set('uid:1', 1.5, 60)
+        warm.set('uid:2', 3)
+        warm.cache_get('uid:1')
+        warm.cache_get('uid:1')
+        warm.cache_get_pipelined(['uid:2', 'uid:3'])
+        path = tempfile.mktemp()
+        warm.hot_keys.save(path)
+        with open(path) as f:
+            keys = json.load(f)
+        os.remove(path)
+        self.assertEqual(keys[0], 'uid:1')
+        cold = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, local_cache_size=10, backend=backend)
+        self.assertEqual(cold.warm(keys), 2)
+        self.assertEqual(cold.local_get('uid:1'), 1.5)
+        self.assertEqual(cold.local_get('uid:2'), 3)
+        self.assertEqual(cold.cache_database.get('uid:2'), '3')
+
+
+class StaleWhileRevalidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, local_cache_size=10, stale_grace=60,
+                                 backend=backends.MemoryBackend())
+
+    def test_cache_lookup_stale(self):
+        self.store.cache_set('uid:1', 1.5, 120)
+        self.assertEqual(self.store.cache_lookup('uid:1'), (1.5, False))
+        self.assertGreater(self.store.cache_database.pttl('uid:1'), 170000)
+        self.store.cache_database.pexpire('uid:1', 30000)
+        self.store.local_cache.delete('uid:1')
+        self.assertEqual(self.store.cache_lookup('uid:1'), (1.5, True))
+        self.assertIsNone(self.store.local_get('uid:1'))
+        stale = set()
+        self.assertEqual(self.store.cache_get_pipelined(['uid:1', 'uid:2'], stale), {'uid:1': 1.5, 'uid:2': None})
+        self.assertEqual(stale, set(['uid:1']))
+
+    def test_get_score_refreshes_in_background(self):
+        key = scoring.score_key('79175002040')
+        self.store.cache_database.set(key, 9.0, px=30000)
+        self.assertEqual(scoring.get_score(self.store, '79175002040', 'a@b.c'), 9.0)
+        for _ in range(100):
+            if not scoring.refreshes.pending:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.store.cache_lookup(key), (3.0, False))
+        self.assertGreater(self.store.cache_database.pttl(key), 3600 * 1000)
+
+    def test_revalidator_deduplicates(self):
+        revalidator = store.Revalidator(workers=1)
+        release = threading.Event()
+        calls = []
+        self.assertTrue(revalidator.submit('uid:1', lambda: calls.append(release.wait(1))))
+        self.assertFalse(revalidator.submit('uid:1', calls.append, 'again'))
+        release.set()
+        for _ in range(100):
+            if not revalidator.pending:
+                break
+            time.sleep(0.01)
+        self.assertEqual(calls, [True])
+        self.assertTrue(revalidator.submit('uid:1', calls.append, 'again'))
+
+
+
+class ScoreBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=backends.MemoryBackend())
+
+    @cases([(None, None, None, None, None, None),
+            ('79175002040', 'a@b.c', None, None, None, None),
+            ('79175002040', None, datetime.date(1980, 11, 25), 1, 'a', 'b'),
+            (None, 'a@b.c', datetime.date(1980, 11, 25), None, 'a', None),
+            ])
+    def test_compute_scores_matches_compute_score(self, *profile):
+        self.assertEqual(scoring.compute_scores(*zip(profile, profile)), [scoring.compute_score(*profile)] * 2)
+
+    def test_get_scores(self):
+        cached = scoring.score_key('79175002040')
+        stored = scoring.score_key('79175002041', None, 'a', 'b')
+        self.store.cache_set(cached, 9.0, 60)
+        self.store.set(stored, 4)
+        profiles = [('79175002040', 'a@b.c', None, None, None, None),
+                    ('79175002041', None, None, None, 'a', 'b'),
+                    (None, None, datetime.date(1980, 11, 25), 1, 'a', 'b'),
+                    (None, 'a@b.c', datetime.date(1980, 11, 25), 2, 'a', 'b')]
+        self.assertEqual(scoring.get_scores(self.store, profiles), [9.0, 4, 2.0, 2.0])
+        computed = scoring.score_key(None, datetime.date(1980, 11, 25), 'a', 'b')
+        self.assertEqual(self.store.cache_get_pipelined([computed]), {computed: 2.0})
+
+
+
+class BatchStoreTest(unittest.TestCase):
+
+    def test_prefetch_reads_only_cache_misses_from_primary(self):
+        primary = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=backends.MemoryBackend())
+        primary.cache_set('uid:1', 2.5, 60)
+        primary.set('uid:2', 4)
+        primary.set('i:1', '["books"]')
+        read = []
+        get_pipelined = primary.get_pipelined
+        primary.get_pipelined = lambda keys: read.extend(keys) or get_pipelined(keys)
+        batch = store.BatchStore(primary)
+        batch.plan(['i:1'], ['uid:1', 'uid:2', 'uid:3'])
+        batch.prefetch()
+        self.assertEqual(sorted(read), ['i:1', 'uid:2', 'uid:3'])
+        self.assertEqual([batch.cache_get(key) for key in ('uid:1', 'uid:2', 'uid:3')], [2.5, 4, None])
+        self.assertEqual(batch.get('i:1'), '["books"]')
+
+
+class CompactInterestsTest(unittest.TestCase):
+
+    def setUp(self):
+        scoring.vocabularies.clear()
+        self.store = store.Store('127.0.0.1', '6379', '6370', 1, 1, 1, backend=backends.MemoryBackend())
+
+    def test_encode_decode(self):
+        encoder = scoring.InterestsEncoder(self.store)
+        first = encoder.encode([u'books', u'travel'])
+        self.assertEqual(first, 'v2:\x00\x01')
+        self.assertEqual(encoder.encode([u'travel', u'books']), 'v2:\x01\x00')
+        self.assertEqual(encoder.encode([]), 'v2:')
+        self.store.set('i:1', first)
+        self.store.set('i:2', encoder.encode([u'hi-tech', u'books']))
+        self.store.set('i:3', json.dumps([u'pets']))
+        scoring.vocabularies.clear()
+        self.assertEqual(scoring.get_interests_many(self.store, [1, 2, 3, 4]),
+                         {1: [u'books', u'travel'], 2: [u'hi-tech', u'books'], 3: [u'pets'], 4: []})
+        self.assertEqual(sorted(scoring.vocabularies), [2, 3])
+        self.assertEqual(scoring.InterestsEncoder(self.store).encode([u'hi-tech']), 'v3:\x02')
+
+    def test_concurrent_encoders_share_versions(self):
+        first, second = scoring.InterestsEncoder(self.store), scoring.InterestsEncoder(self.store)
+        self.assertEqual(first.encode([u'books']), 'v1:\x00')
+        self.assertEqual(second.encode([u'travel']), 'v2:\x01')
+        self.assertEqual(first.encode([u'pets', u'travel']), 'v3:\x02\x01')
+        self.store.set(scoring.VOCABULARY_KEY, 1)
+        scoring.vocabularies.clear()
+        self.assertEqual(scoring.InterestsEncoder(self.store).encode([u'pets']), 'v3:\x02')
+        self.assertEqual([json.loads(self.store.get(scoring.vocabulary_key(version))) for version in (1, 2, 3)],
+                         [[u'books'], [u'books', u'travel'], [u'books', u'travel', u'pets']])
+        self.assertEqual(scoring.decode_interests(self.store, 'v2:\x01\x00'), [u'travel', u'books'])
+
+    def test_unknown_vocabulary(self):
+        with self.assertRaises(ValueError):
+            scoring.decode_interests(self.store, 'v7:\x00')
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def test_expired_deadline_skips_call(self):
+        flaky = Flaky(0)
+        with store.deadline(time.time() - 1):
+            with self.assertRaises(store.DeadlineExceeded):
+                flaky.call()
+        self.assertEqual(flaky.calls, 0)
+        self.assertEqual(flaky.call(), 'ok')
+
+    def test_retry_stops_when_pause_exceeds_budget(self):
+        flaky = Flaky(1)
+        flaky.retry_pause = lambda attempt: 1
+        started = time.time()
+        with store.deadline(time.time() + 0.1):
+            with self.assertRaises(store.DeadlineExceeded):
+                flaky.call()
+        self.assertLess(time.time() - started, 0.1)
+        self.assertEqual(flaky.calls, 1)
+        self.assertIsNone(store.remaining())
+
+    def test_swallowed_errors_still_raise_deadline(self):
+        cache = store.Store('127.0.0.1', '1', '1', 1, 1, 3, retry_delay=1)
+        with store.deadline(time.time() + 0.2):
+            with self.assertRaises(store.DeadlineExceeded):
+                cache.cache_get('uid:1')
+
+    def test_single_flight_follower_deadline(self):
+        flights = store.SingleFlight()
+        release = threading.Event()
+        leader = threading.Thread(target=flights.do, args=('uid:1', release.wait, 1))
+        leader.start()
+        while not flights.flights:
+            time.sleep(0.001)
+        with store.deadline(time.time() + 0.02):
+            with self.assertRaises(store.DeadlineExceeded):
+                flights.do('uid:1', lambda: None)
+        release.set()
+        leader.join()
+
+    def test_short_deadlines_do_not_open_breaker(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        self.addCleanup(server.close)
+        port = server.getsockname()[1]
+        slow = store.Store('127.0.0.1', port, port, 10, 1, 3, retry_delay=1, breaker_threshold=2)
+        breaker = slow.breakers['database']
+        for _ in range(5):
+            with store.deadline(time.time() + 0.02):
+                with self.assertRaises(store.DeadlineExceeded):
+                    slow.get('i:1')
+        self.assertEqual(breaker.state, store.CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.counters['failures'], 0)
+        breaker.transition(breaker.HALF_OPEN)
+        with store.deadline(time.time() + 0.02):
+            with self.assertRaises(store.DeadlineExceeded):
+                slow.get('i:1')
+        self.assertTrue(breaker.allow())
+
+    def test_hung_server_bounded_by_deadline(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        self.addCleanup(server.close)
+        port = server.getsockname()[1]
+        hung = store.Store('127.0.0.1', port, port, 10, 1, 3, retry_delay=1)
+        started = time.time()
+        with store.deadline(time.time() + 0.2):
+            with self.assertRaises(store.DeadlineExceeded):
+                hung.get('i:1')
+        self.assertLess(time.time() - started, 0.5)
+
+    def test_pool_wait_bounded_by_deadline(self):
+        server = resp_server.RESPServer(('127.0.0.1', 0))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        port = server.server_address[1]
+        busy = store.Store('127.0.0.1', port, port, 1, 1, 3, pool_size=1, pool_timeout=5, retry_delay=1)
+        pool = busy.database.connection_pool
+        connection = pool.get_connection('GET')
+        started = time.time()
+        with store.deadline(time.time() + 0.2):
+            with self.assertRaises(store.DeadlineExceeded):
+                busy.get('i:1')
+        self.assertLess(time.time() - started, 0.5)
+        pool.release(connection)
+        self.assertIsNone(busy.get('i:1'))
+        self.assertEqual(connection._sock.gettimeout(), 1)
+
+    def test_reconnect_after_server_closes_pooled_connections(self):
+        class ClosingServer(resp_server.RESPServer):
+            def process_request(self, request, client_address):
+                clients.append(request)
+                resp_server.RESPServer.process_request(self, request, client_address)
+        clients = []
+        server = ClosingServer(('127.0.0.1', 0))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        port = server.server_address[1]
+        restarted = store.Store('127.0.0.1', port, port, 1, 1, 3, retry_delay=0.01)
+        restarted.set('i:1', 1)
+        for client in clients:
+            client.shutdown(socket.SHUT_RDWR)
+        time.sleep(0.05)
+        for _ in range(4):
+            with store.deadline(time.time() + 1):
+                self.assertEqual(restarted.get('i:1'), '1')
+        self.assertEqual(restarted.breakers['database'].counters['failures'], 0)
+
 if __name__ == "__main__":
     unittest.main()
 